@@ -0,0 +1,113 @@
+#!/usr/bin/env python3
+
+import argparse
+import json
+import logging as l
+import resource
+import time
+import tracemalloc
+from typing import List, Dict
+
+import configuration
+from repository import Repo
+from stub import StubProcess, Scenario, scenario
+from trigger import create_plugin
+
+
+def run_scenario(config: configuration.Config, scenario: Scenario, runs: int, trace_memory: bool) -> List[dict]:
+    results = []
+    with StubProcess(scenario) as stub:
+        config = config._replace(drone_api=stub.drone_api, gogs_api=stub.gogs_api, from_=[scenario.from_],
+                                 source="benchmark/base")
+        for run in range(1, runs + 1):
+            before = stub.stats()
+            plugin, close = create_plugin(config)
+            if trace_memory:
+                tracemalloc.start()
+            started = time.perf_counter()
+            failed = False
+            try:
+                plugin.run(config.from_, Repo.from_full_name(config.source), config.dry_run, config.collapse_triggers)
+            except SystemExit:
+                failed = True
+            finally:
+                wall_time = time.perf_counter() - started
+                peak_memory = tracemalloc.get_traced_memory()[1] if trace_memory else None
+                tracemalloc.stop()
+                close()
+            after = stub.stats()
+            results.append({
+                "scenario": scenario._asdict(),
+                "run": run,
+                "failed": failed,
+                "wall_time": round(wall_time, 3),
+                "requests": difference(after["requests"], before["requests"]),
+                "statuses": difference(after["statuses"], before["statuses"]),
+                "bytes": after["bytes"] - before["bytes"],
+                "builds_triggered": after["builds"] - before["builds"],
+                "peak_running_builds": after["peak_running_builds"],
+                "peak_memory": peak_memory,
+            })
+    return results
+
+
+def difference(after: Dict[str, int], before: Dict[str, int]) -> Dict[str, int]:
+    return {key: after[key] - before.get(key, 0) for key in sorted(after) if after[key] != before.get(key, 0)}
+
+
+def print_result(result: dict) -> None:
+    s = result["scenario"]
+    print("repos={repos} branches={branches} dockerfile_ratio={dockerfile_ratio} latency={latency} "
+          "error_rate={error_rate}".format(**s))
+    peak_memory = result["peak_memory"]
+    memory = "" if peak_memory is None else ", {:.1f} MiB peak memory".format(peak_memory / 2 ** 20)
+    print("  run {run}{failed}: {wall_time:.3f}s wall time, {requests} requests, {kib:.0f} KiB transferred, "
+          "{builds} builds triggered{memory}".format(run=result["run"], failed=" (failed)" if result["failed"] else "",
+                                                    wall_time=result["wall_time"], builds=result["builds_triggered"],
+                                                    requests=sum(result["requests"].values()),
+                                                    kib=result["bytes"] / 1024, memory=memory))
+    if result["scenario"]["build_time"]:
+        print("    at most {} builds running at once".format(result["peak_running_builds"]))
+    for endpoint, count in result["requests"].items():
+        print("    {:>8} {}".format(count, endpoint))
+    print("    statuses: {}".format(", ".join("{}={}".format(k, v) for k, v in result["statuses"].items())))
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(
+        description="Benchmark TriggerPlugin.run against stub Gogs/Drone APIs. Plugin options such as "
+                    "PLUGIN_CONCURRENCY or PLUGIN_CACHE_DIR are taken from the environment.")
+    parser.add_argument("--repos", default="100,1000", help="comma-separated repo counts, one scenario each")
+    parser.add_argument("--branches", type=int, default=4, help="branches per repo")
+    parser.add_argument("--dockerfile-ratio", type=float, default=0.5, help="share of repos with a Dockerfile")
+    parser.add_argument("--latency", type=float, default=0.0, help="seconds added to every response")
+    parser.add_argument("--error-rate", type=float, default=0.0, help="share of requests answered with 503")
+    parser.add_argument("--build-time", type=float, default=0.0, help="seconds a triggered build keeps running")
+    parser.add_argument("--runs", type=int, default=1, help="runs per scenario, e.g. to compare cold and warm caches")
+    parser.add_argument("--no-trace-memory", dest="trace_memory", action="store_false",
+                        help="skip measuring peak memory, tracing allocations slows the plugin down")
+    parser.add_argument("--json", help="write the results to this file")
+    parser.add_argument("--verbose", action="store_true", help="show the log output of the plugin")
+    args = parser.parse_args()
+
+    l.basicConfig(format='%(asctime)s %(levelname)-8s %(message)s', datefmt='%H:%M:%S',
+                  level=l.INFO if args.verbose else l.CRITICAL)
+    config = configuration.Config.create_from_env()
+
+    results = []
+    for repos in (int(count) for count in args.repos.split(",")):
+        s = scenario(repos, args.branches, args.dockerfile_ratio, args.latency, args.error_rate,
+                     build_time=args.build_time)
+        for result in run_scenario(config, s, args.runs, args.trace_memory):
+            print_result(result)
+            results.append(result)
+    print("max resident set size of the benchmark: {:.1f} MiB".format(
+        resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024))
+
+    if args.json:
+        with open(args.json, "w") as f:
+            json.dump(results, f, indent=2)
+
+
+if __name__ == "__main__":
+    main()
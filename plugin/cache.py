@@ -0,0 +1,337 @@
+import json
+import logging as l
+import os
+import sqlite3
+import threading
+import time
+from typing import NamedTuple, Optional, List, Tuple, Set, Dict
+
+from dockerfile import normalize_image
+from repository import Repo, Branch
+
+# types
+from repository import Branches
+
+
+class SqliteStore(object):
+    # Subclasses declare their tables in SCHEMA and bump VERSION whenever it changes,
+    # a database with another version is wiped instead of migrated, it only holds cached data.
+    FILENAME = None  # type: str
+    VERSION = 1
+    SCHEMA = ""
+
+    def __init__(self, directory: str) -> None:
+        self.path = os.path.join(directory, self.FILENAME)
+        self._lock = threading.Lock()
+        os.makedirs(directory, exist_ok=True)
+        try:
+            self._db = self._open(self.path)
+        except sqlite3.OperationalError as e:
+            l.warning("Unable to open cache %s, falling back to an in-memory cache: %s", self.path, e)
+            self._db = self._open(":memory:")
+        except sqlite3.DatabaseError as e:
+            l.warning("Discarding corrupted cache %s: %s", self.path, e)
+            os.replace(self.path, self.path + ".corrupt")
+            self._db = self._open(self.path)
+
+    def _open(self, path: str) -> sqlite3.Connection:
+        # connections are shared between worker threads, access is serialized by self._lock
+        db = sqlite3.connect(path, timeout=30, isolation_level=None, check_same_thread=False)
+        try:
+            db.execute("PRAGMA journal_mode=WAL")
+            # commits do not wait for the disk, a crash may only lose the last writes to a cache
+            db.execute("PRAGMA synchronous=NORMAL")
+            # concurrent runs may open a fresh database at the same time, only one of them creates the schema
+            db.execute("BEGIN IMMEDIATE")
+            version = db.execute("PRAGMA user_version").fetchone()[0]
+            if version != self.VERSION:
+                # SQLite's own tables, e.g. the sequences of AUTOINCREMENT columns, cannot be dropped
+                rows = db.execute("SELECT name FROM sqlite_master WHERE type = 'table'")
+                tables = [row[0] for row in rows if not row[0].startswith("sqlite_")]
+                for table in tables:
+                    db.execute("DROP TABLE IF EXISTS {}".format(table))
+                for statement in self.SCHEMA.split(";"):
+                    if statement.strip():
+                        db.execute(statement)
+                db.execute("PRAGMA user_version = {:d}".format(self.VERSION))
+            db.execute("COMMIT")
+            return db
+        except sqlite3.DatabaseError:
+            db.close()
+            raise
+
+    def execute(self, sql: str, parameters: Tuple = ()) -> List[Tuple]:
+        # a cache that cannot be read or written (locked by a concurrent run for too long, broken file system)
+        # degrades to a miss instead of failing the run
+        try:
+            with self._lock:
+                return self._db.execute(sql, parameters).fetchall()
+        except sqlite3.DatabaseError as e:
+            l.warning("Unable to access cache %s: %s", self.path, e)
+            return []
+
+    def execute_atomically(self, statements: List[Tuple[str, Tuple]]) -> Optional[List[Tuple]]:
+        # returns the rows of the last statement, or None if the transaction failed
+        try:
+            with self._lock:
+                self._db.execute("BEGIN IMMEDIATE")
+                try:
+                    rows = [self._db.execute(sql, parameters).fetchall() for sql, parameters in statements]
+                except BaseException:
+                    self._db.execute("ROLLBACK")
+                    raise
+                self._db.execute("COMMIT")
+                return rows[-1] if rows else []
+        except sqlite3.DatabaseError as e:
+            l.warning("Unable to update cache %s: %s", self.path, e)
+            return None
+
+    def close(self) -> None:
+        with self._lock:
+            self._db.close()
+
+
+def escape_like(value: str) -> str:
+    return value.replace("\\", "\\\\").replace("%", "\\%").replace("_", "\\_")
+
+
+CachedBlob = NamedTuple("CachedBlob", [("content", Optional[str])])
+
+
+class DockerfileCache(SqliteStore):
+    FILENAME = "dockerfiles.sqlite"
+    VERSION = 1
+    SCHEMA = """
+        CREATE TABLE blobs (
+            repo TEXT NOT NULL,
+            sha1 TEXT NOT NULL,
+            path TEXT NOT NULL,
+            content TEXT,
+            created REAL NOT NULL,
+            accessed REAL NOT NULL,
+            PRIMARY KEY (repo, sha1, path)
+        );
+        CREATE INDEX blobs_accessed ON blobs (accessed);
+    """
+
+    def __init__(self, directory: str, max_age: int, max_entries: int) -> None:
+        super().__init__(directory)
+        self.max_age = max_age
+        self.max_entries = max_entries
+
+    def get(self, repo: Repo, sha1: str, path: str) -> Optional[CachedBlob]:
+        now = time.time()
+        rows = self.execute("SELECT content FROM blobs WHERE repo = ? AND sha1 = ? AND path = ? AND created >= ?",
+                            (repo.full_name, sha1, path, now - self.max_age))
+        if not rows:
+            return None
+        self.execute("UPDATE blobs SET accessed = ? WHERE repo = ? AND sha1 = ? AND path = ?",
+                     (now, repo.full_name, sha1, path))
+        return CachedBlob(rows[0][0])
+
+    def put(self, repo: Repo, sha1: str, path: str, content: Optional[str]) -> None:
+        now = time.time()
+        self.execute("INSERT OR REPLACE INTO blobs (repo, sha1, path, content, created, accessed) "
+                     "VALUES (?, ?, ?, ?, ?, ?)", (repo.full_name, sha1, path, content, now, now))
+
+    def evict(self) -> None:
+        self.execute("DELETE FROM blobs WHERE created < ?", (time.time() - self.max_age,))
+        self.execute("DELETE FROM blobs WHERE rowid NOT IN "
+                     "(SELECT rowid FROM blobs ORDER BY accessed DESC LIMIT ?)", (self.max_entries,))
+
+
+CachedResponse = NamedTuple("CachedResponse", [("etag", str), ("headers", List[Tuple[str, str]]), ("body", bytes)])
+
+
+class ResponseCache(SqliteStore):
+    # bodies of GET responses with an ETag, a request for the same URL asks whether they are still current
+    FILENAME = "responses.sqlite"
+    VERSION = 1
+    SCHEMA = """
+        CREATE TABLE responses (
+            url TEXT PRIMARY KEY,
+            etag TEXT NOT NULL,
+            headers TEXT NOT NULL,
+            body BLOB NOT NULL,
+            accessed REAL NOT NULL
+        );
+        CREATE INDEX responses_accessed ON responses (accessed);
+    """
+
+    def __init__(self, directory: str, max_entries: int) -> None:
+        super().__init__(directory)
+        self.max_entries = max_entries
+
+    def get(self, url: str) -> Optional[CachedResponse]:
+        rows = self.execute("SELECT etag, headers, body FROM responses WHERE url = ?", (url,))
+        if not rows:
+            return None
+        self.execute("UPDATE responses SET accessed = ? WHERE url = ?", (time.time(), url))
+        etag, headers, body = rows[0]
+        return CachedResponse(etag, [(key, value) for key, value in json.loads(headers)], body)
+
+    def put(self, url: str, etag: str, headers: List[Tuple[str, str]], body: bytes) -> None:
+        self.execute("INSERT OR REPLACE INTO responses (url, etag, headers, body, accessed) VALUES (?, ?, ?, ?, ?)",
+                     (url, etag, json.dumps(headers), body, time.time()))
+
+    def evict(self) -> None:
+        self.execute("DELETE FROM responses WHERE rowid NOT IN "
+                     "(SELECT rowid FROM responses ORDER BY accessed DESC LIMIT ?)", (self.max_entries,))
+
+
+class StateStore(SqliteStore):
+    # results of previous runs: the FROM images of every evaluated branch head and the Drone hook token of every repo,
+    # the images double as reverse index from an image to the branches building on top of it
+    FILENAME = "state.sqlite"
+    VERSION = 6
+    SCHEMA = """
+        CREATE TABLE images (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            repo TEXT NOT NULL,
+            branch TEXT NOT NULL,
+            sha1 TEXT NOT NULL,
+            image TEXT,
+            evaluated REAL NOT NULL
+        );
+        CREATE INDEX images_branch ON images (repo, branch);
+        CREATE INDEX images_image ON images (image);
+        CREATE TABLE tokens (
+            repo TEXT PRIMARY KEY,
+            token TEXT NOT NULL,
+            fetched REAL NOT NULL
+        );
+        CREATE TABLE settings (
+            key TEXT PRIMARY KEY,
+            value TEXT NOT NULL
+        );
+    """
+
+    def __init__(self, directory: str, max_age: int, token_max_age: int = None, discovery: str = "") -> None:
+        super().__init__(directory)
+        self.max_age = max_age
+        self.token_max_age = token_max_age or max_age
+        self.discard_images_of_other_discovery(discovery)
+
+    def discard_images_of_other_discovery(self, discovery: str) -> None:
+        # images found with other Dockerfile discovery settings, e.g. before Dockerfile patterns were configured,
+        # would hide the Dockerfiles the current settings find
+        rows = self.execute("SELECT value FROM settings WHERE key = 'discovery'")
+        if rows and rows[0][0] == discovery:
+            return
+        if rows:
+            l.info("Discarding the evaluated branches in %s, the Dockerfile discovery settings changed.", self.path)
+        self.execute_atomically([("DELETE FROM images", ()),
+                                 ("INSERT OR REPLACE INTO settings (key, value) VALUES ('discovery', ?)",
+                                  (discovery,))])
+
+    def get_images(self, repo: Repo, branch: Branch) -> Optional[List[str]]:
+        # a branch without any image is stored as a single row with a NULL image
+        rows = self.execute("SELECT image FROM images WHERE repo = ? AND branch = ? AND sha1 = ? AND evaluated >= ?",
+                            (repo.full_name, branch.name, branch.sha1, time.time() - self.max_age))
+        if not rows:
+            return None
+        return [image for image, in rows if image is not None]
+
+    def put_images(self, repo: Repo, branch: Branch, images: List[str]) -> None:
+        now = time.time()
+        statements = [("DELETE FROM images WHERE repo = ? AND branch = ?", (repo.full_name, branch.name))]
+        statements += [("INSERT INTO images (repo, branch, sha1, image, evaluated) VALUES (?, ?, ?, ?, ?)",
+                        (repo.full_name, branch.name, branch.sha1, image, now)) for image in images or [None]]
+        self.execute_atomically(statements)
+
+    def retain_branches(self, repo: Repo, branches: Branches) -> None:
+        names = [branch.name for branch in branches]
+        self.execute("DELETE FROM images WHERE repo = ? AND branch NOT IN ({})".format(",".join("?" * len(names))),
+                     (repo.full_name,) + tuple(names))
+
+    def drop_branch(self, repo: Repo, branch_name: str) -> None:
+        self.execute("DELETE FROM images WHERE repo = ? AND branch = ?", (repo.full_name, branch_name))
+
+    def last_evaluation(self) -> int:
+        # ids only ever grow, rows up to this id were committed before any lookup that follows
+        rows = self.execute("SELECT MAX(id) FROM images")
+        return (rows[0][0] or 0) if rows else 0
+
+    def evaluated_branches(self, repo: Repo, until: int) -> Set[Branch]:
+        # the branches whose images were stored up to the given evaluation, e.g. before the images were looked up
+        rows = self.execute("SELECT DISTINCT branch, sha1 FROM images WHERE repo = ? AND id <= ? AND evaluated >= ?",
+                            (repo.full_name, until, time.time() - self.max_age))
+        return {Branch(branch, sha1) for branch, sha1 in rows}
+
+    def indexed_images(self) -> Dict[Tuple[Repo, Branch], List[str]]:
+        rows = self.execute("SELECT repo, branch, sha1, image FROM images WHERE evaluated >= ?",
+                            (time.time() - self.max_age,))
+        images = {}  # type: Dict[Tuple[Repo, Branch], List[str]]
+        for repo, branch, sha1, image in rows:
+            images_of_branch = images.setdefault((Repo.from_full_name(repo), Branch(branch, sha1)), [])
+            if image is not None:
+                images_of_branch.append(image)
+        return images
+
+    def lookup(self, image: str) -> List[Tuple[Repo, Branch]]:
+        # images are stored normalized, pinned digests of the image match as well unless it is pinned itself
+        image = normalize_image(image)
+        pinned = escape_like(image) + ("" if "@" in image else "@%")
+        rows = self.execute("SELECT DISTINCT repo, branch, sha1 FROM images "
+                            "WHERE (image = ? OR image LIKE ? ESCAPE '\\') AND evaluated >= ? ORDER BY repo, branch",
+                            (image, pinned, time.time() - self.max_age))
+        return [(Repo.from_full_name(repo), Branch(branch, sha1)) for repo, branch, sha1 in rows]
+
+    def get_token(self, repo: Repo) -> Optional[str]:
+        rows = self.execute("SELECT token FROM tokens WHERE repo = ? AND fetched >= ?",
+                            (repo.full_name, time.time() - self.token_max_age))
+        return rows[0][0] if rows else None
+
+    def put_token(self, repo: Repo, token: str) -> None:
+        self.execute("INSERT OR REPLACE INTO tokens (repo, token, fetched) VALUES (?, ?, ?)",
+                     (repo.full_name, token, time.time()))
+
+    def drop_token(self, repo: Repo) -> None:
+        self.execute("DELETE FROM tokens WHERE repo = ?", (repo.full_name,))
+
+    def evict(self) -> None:
+        self.execute("DELETE FROM images WHERE evaluated < ?", (time.time() - self.max_age,))
+        self.execute("DELETE FROM tokens WHERE fetched < ?", (time.time() - self.token_max_age,))
+
+
+class TriggerLedger(SqliteStore):
+    # builds triggered by recent runs: runs for the same upstream event, e.g. a retried upstream build or several
+    # tags built from one commit, do not trigger a downstream commit again. BEGIN IMMEDIATE takes the database's
+    # write lock, so concurrent runs cannot both claim the same trigger.
+    FILENAME = "triggers.sqlite"
+    VERSION = 1
+    SCHEMA = """
+        CREATE TABLE triggers (
+            repo TEXT NOT NULL,
+            branch TEXT NOT NULL,
+            sha1 TEXT NOT NULL,
+            source TEXT NOT NULL,
+            triggered REAL NOT NULL,
+            PRIMARY KEY (repo, branch, sha1, source)
+        );
+        CREATE INDEX triggers_triggered ON triggers (triggered);
+    """
+
+    def __init__(self, directory: str, window: int) -> None:
+        super().__init__(directory)
+        self.window = window
+
+    def claim(self, repo: Repo, branch: Branch, source: Repo) -> bool:
+        now = time.time()
+        key = (repo.full_name, branch.name, branch.sha1, source.full_name)
+        rows = self.execute_atomically([
+            ("DELETE FROM triggers WHERE repo = ? AND branch = ? AND sha1 = ? AND source = ? AND triggered < ?",
+             key + (now - self.window,)),
+            ("INSERT OR IGNORE INTO triggers (repo, branch, sha1, source, triggered) VALUES (?, ?, ?, ?, ?)",
+             key + (now,)),
+            ("SELECT changes()", ()),
+        ])
+        # without a working ledger builds are rather triggered twice than not at all
+        return rows is None or rows[0][0] > 0
+
+    def release(self, repo: Repo, branch: Branch, source: Repo) -> None:
+        self.execute("DELETE FROM triggers WHERE repo = ? AND branch = ? AND sha1 = ? AND source = ?",
+                     (repo.full_name, branch.name, branch.sha1, source.full_name))
+
+    def evict(self) -> None:
+        self.execute("DELETE FROM triggers WHERE triggered < ?", (time.time() - self.window,))
@@ -0,0 +1,73 @@
+import logging as l
+from typing import Callable, Dict, List, NamedTuple, Optional, Set, Tuple
+
+from dockerfile import matching_from, repository_of
+from repository import Repo, Branch
+
+# types
+from repository import BranchesOfRepos
+
+ImagesOfBranches = Dict[Repo, List[Tuple[Branch, List[str]]]]
+
+CascadePlan = NamedTuple("CascadePlan", [("waves", List[BranchesOfRepos]),
+                                         ("parents", Dict[Repo, Set[Optional[Repo]]])])
+
+
+def plan_cascade(images_of_branches: ImagesOfBranches, froms: List[str], source: Repo,
+                 image_of_repo: Callable[[Repo], str]) -> CascadePlan:
+    # A repo is a child of the repo building the image its Dockerfile is based on, the source images are
+    # represented by the parent None. Every repo reachable from a source image ends up in exactly one wave,
+    # the length of the longest path leading to it, so all its ancestors are built before it.
+    built_by = {repository_of(image_of_repo(repo)): repo for repo in images_of_branches}
+
+    children = {}  # type: Dict[Optional[Repo], Dict[Repo, List[Branch]]]
+    for repo, branches in images_of_branches.items():
+        if repo == source:
+            continue
+        for branch, images in branches:
+            for image in images:
+                if matching_from([image], froms):
+                    parent = None
+                else:
+                    parent = built_by.get(repository_of(image))
+                    if parent is None or parent == repo:
+                        continue
+                branches_of_child = children.setdefault(parent, {}).setdefault(repo, [])
+                if branch not in branches_of_child:
+                    branches_of_child.append(branch)
+
+    reachable = set()  # type: Set[Repo]
+    queue = list(children.get(None, {}))
+    while queue:
+        repo = queue.pop()
+        if repo not in reachable:
+            reachable.add(repo)
+            queue.extend(children.get(repo, {}))
+
+    parents = {repo: set() for repo in reachable}  # type: Dict[Repo, Set[Optional[Repo]]]
+    for parent, children_of_parent in children.items():
+        if parent is None or parent in reachable:
+            for child in children_of_parent:
+                if child in reachable:
+                    parents[child].add(parent)
+
+    waves = []
+    placed = {None}  # type: Set[Optional[Repo]]
+    remaining = set(reachable)
+    while remaining:
+        wave = sorted(repo for repo in remaining if parents[repo] <= placed)
+        if not wave:
+            l.warning("Not cascading to %s, their images depend on each other.", ", ".join(map(str, sorted(remaining))))
+            break
+        waves.append({repo: branches_with_parents(repo, parents[repo], children) for repo in wave})
+        placed.update(wave)
+        remaining.difference_update(wave)
+    return CascadePlan(waves, parents)
+
+
+def branches_with_parents(repo: Repo, parents: Set[Optional[Repo]],
+                          children: Dict[Optional[Repo], Dict[Repo, List[Branch]]]) -> List[Branch]:
+    branches = []
+    for parent in sorted(parents, key=lambda parent: (parent is not None, parent)):
+        branches.extend(branch for branch in children[parent][repo] if branch not in branches)
+    return branches
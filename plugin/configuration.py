@@ -1,12 +1,29 @@
 import os
 import logging as l
+import re
 import urllib.parse
-from typing import NamedTuple
+from typing import NamedTuple, List
+
+from filters import compile_branch_pattern
 
 
 class Config(NamedTuple("Config",
                         [("drone_api", str), ("drone_token", str), ("gogs_api", str), ("gogs_token", str),
-                         ("from_", str), ("source", str), ("dry_run", str), ("verbose", str)])):
+                         ("from_", List[str]), ("source", str), ("dry_run", str), ("verbose", str),
+                         ("concurrency", int), ("cache_dir", str), ("cache_max_age", int),
+                         ("cache_max_entries", int), ("state_max_age", int), ("token_max_age", int),
+                         ("prefetch_tokens", bool),
+                         ("dockerfile_patterns", List[str]), ("collapse_triggers", bool),
+                         ("cascade", bool), ("cascade_image", str), ("cascade_timeout", int),
+                         ("cascade_poll_interval", int), ("server_url", str), ("server_token", str),
+                         ("server_port", int), ("server_secret", str), ("server_refresh_interval", int),
+                         ("metrics_file", str), ("metrics_textfile", str), ("request_timeout", int),
+                         ("request_retries", int), ("run_deadline", int), ("hedge_after_millis", int),
+                         ("rate_limit", int), ("max_running_builds", int), ("build_poll_interval", int),
+                         ("coalesce_window", int), ("include_repos", List[str]), ("exclude_repos", List[str]),
+                         ("include_branches", List[str]), ("exclude_branches", List[str]), ("active_only", bool),
+                         ("max_commit_age", int), ("response_cache_entries", int), ("max_response_size", int),
+                         ("plan_file", str), ("execute_plan", bool)])):
     PREFIX_YAML = "PLUGIN_"
     PREFIX_ENCRYPTED = "TRIGGER_"
     DRONE_API = "DRONE_API"
@@ -17,6 +34,44 @@ class Config(NamedTuple("Config",
     SOURCE = "DRONE_REPO"
     DRY_RUN = "DRY_RUN"
     VERBOSE = "VERBOSE"
+    CONCURRENCY = "CONCURRENCY"
+    CACHE_DIR = "CACHE_DIR"
+    CACHE_MAX_AGE = "CACHE_MAX_AGE"
+    CACHE_MAX_ENTRIES = "CACHE_MAX_ENTRIES"
+    STATE_MAX_AGE = "STATE_MAX_AGE"
+    TOKEN_MAX_AGE = "TOKEN_MAX_AGE"
+    PREFETCH_TOKENS = "PREFETCH_TOKENS"
+    DOCKERFILE_PATTERNS = "DOCKERFILE_PATTERNS"
+    COLLAPSE_TRIGGERS = "COLLAPSE_TRIGGERS"
+    CASCADE = "CASCADE"
+    CASCADE_IMAGE = "CASCADE_IMAGE"
+    CASCADE_TIMEOUT = "CASCADE_TIMEOUT"
+    CASCADE_POLL_INTERVAL = "CASCADE_POLL_INTERVAL"
+    SERVER_URL = "SERVER_URL"
+    SERVER_TOKEN = "SERVER_TOKEN"
+    SERVER_PORT = "SERVER_PORT"
+    SERVER_SECRET = "SERVER_SECRET"
+    SERVER_REFRESH_INTERVAL = "SERVER_REFRESH_INTERVAL"
+    METRICS_FILE = "METRICS_FILE"
+    METRICS_TEXTFILE = "METRICS_TEXTFILE"
+    REQUEST_TIMEOUT = "REQUEST_TIMEOUT"
+    REQUEST_RETRIES = "REQUEST_RETRIES"
+    RUN_DEADLINE = "RUN_DEADLINE"
+    HEDGE_AFTER_MILLIS = "HEDGE_AFTER_MILLIS"
+    RATE_LIMIT = "RATE_LIMIT"
+    MAX_RUNNING_BUILDS = "MAX_RUNNING_BUILDS"
+    BUILD_POLL_INTERVAL = "BUILD_POLL_INTERVAL"
+    COALESCE_WINDOW = "COALESCE_WINDOW"
+    INCLUDE_REPOS = "INCLUDE_REPOS"
+    EXCLUDE_REPOS = "EXCLUDE_REPOS"
+    INCLUDE_BRANCHES = "INCLUDE_BRANCHES"
+    EXCLUDE_BRANCHES = "EXCLUDE_BRANCHES"
+    ACTIVE_ONLY = "ACTIVE_ONLY"
+    MAX_COMMIT_AGE = "MAX_COMMIT_AGE"
+    RESPONSE_CACHE_ENTRIES = "RESPONSE_CACHE_ENTRIES"
+    MAX_RESPONSE_SIZE = "MAX_RESPONSE_SIZE"
+    PLAN_FILE = "PLAN_FILE"
+    EXECUTE_PLAN = "EXECUTE_PLAN"
 
     @classmethod
     def create_from_env(cls) -> "Config":
@@ -26,19 +81,129 @@ class Config(NamedTuple("Config",
         def option_as_bool(option: str) -> bool:
             return bool(option) and option.lower() in ("true", "yes")
 
+        def option_as_int(option: str, default: int) -> int:
+            value = get_either_from_yaml_or_from_secret_store(option)
+            try:
+                return int(value) if value else default
+            except ValueError:
+                l.error("Invalid integer specified as %s: %s", option.lower(), value)
+                raise SystemExit()
+
+        def option_as_list(option: str) -> List[str]:
+            value = get_either_from_yaml_or_from_secret_store(option)
+            return [item.strip() for item in value.split(",") if item.strip()] if value else []
+
         drone_api = get_either_from_yaml_or_from_secret_store(Config.DRONE_API)
         drone_token = get_either_from_yaml_or_from_secret_store(Config.DRONE_TOKEN)
         gogs_api = get_either_from_yaml_or_from_secret_store(Config.GOGS_API)
         gogs_token = get_either_from_yaml_or_from_secret_store(Config.GOGS_TOKEN)
-        from_ = get_either_from_yaml_or_from_secret_store(Config.FROM)
+        from_ = option_as_list(Config.FROM)
         source = os.getenv(Config.SOURCE)
         dry_run = option_as_bool(get_either_from_yaml_or_from_secret_store(Config.DRY_RUN))
         verbose = option_as_bool(get_either_from_yaml_or_from_secret_store(Config.VERBOSE))
+        concurrency = option_as_int(Config.CONCURRENCY, 1)
+        cache_dir = get_either_from_yaml_or_from_secret_store(Config.CACHE_DIR)
+        cache_max_age = option_as_int(Config.CACHE_MAX_AGE, 7 * 24 * 60 * 60)
+        cache_max_entries = option_as_int(Config.CACHE_MAX_ENTRIES, 100000)
+        state_max_age = option_as_int(Config.STATE_MAX_AGE, 24 * 60 * 60)
+        token_max_age = option_as_int(Config.TOKEN_MAX_AGE, 7 * 24 * 60 * 60)
+        prefetch_tokens = option_as_bool(get_either_from_yaml_or_from_secret_store(Config.PREFETCH_TOKENS))
+        dockerfile_patterns = option_as_list(Config.DOCKERFILE_PATTERNS)
+        collapse_triggers = option_as_bool(get_either_from_yaml_or_from_secret_store(Config.COLLAPSE_TRIGGERS))
+        cascade = option_as_bool(get_either_from_yaml_or_from_secret_store(Config.CASCADE))
+        cascade_image = get_either_from_yaml_or_from_secret_store(Config.CASCADE_IMAGE) or "{owner}/{name}"
+        cascade_timeout = option_as_int(Config.CASCADE_TIMEOUT, 60 * 60)
+        cascade_poll_interval = option_as_int(Config.CASCADE_POLL_INTERVAL, 15)
+        server_url = get_either_from_yaml_or_from_secret_store(Config.SERVER_URL)
+        server_token = get_either_from_yaml_or_from_secret_store(Config.SERVER_TOKEN)
+        server_port = option_as_int(Config.SERVER_PORT, 8080)
+        server_secret = get_either_from_yaml_or_from_secret_store(Config.SERVER_SECRET)
+        server_refresh_interval = option_as_int(Config.SERVER_REFRESH_INTERVAL, 0)
+        metrics_file = get_either_from_yaml_or_from_secret_store(Config.METRICS_FILE)
+        metrics_textfile = get_either_from_yaml_or_from_secret_store(Config.METRICS_TEXTFILE)
+        request_timeout = option_as_int(Config.REQUEST_TIMEOUT, 30)
+        request_retries = option_as_int(Config.REQUEST_RETRIES, 2)
+        run_deadline = option_as_int(Config.RUN_DEADLINE, 0)
+        hedge_after_millis = option_as_int(Config.HEDGE_AFTER_MILLIS, 0)
+        rate_limit = option_as_int(Config.RATE_LIMIT, 0)
+        max_running_builds = option_as_int(Config.MAX_RUNNING_BUILDS, 0)
+        build_poll_interval = option_as_int(Config.BUILD_POLL_INTERVAL, 15)
+        coalesce_window = option_as_int(Config.COALESCE_WINDOW, 0)
+        include_repos = option_as_list(Config.INCLUDE_REPOS)
+        exclude_repos = option_as_list(Config.EXCLUDE_REPOS)
+        include_branches = option_as_list(Config.INCLUDE_BRANCHES)
+        exclude_branches = option_as_list(Config.EXCLUDE_BRANCHES)
+        active_only = option_as_bool(get_either_from_yaml_or_from_secret_store(Config.ACTIVE_ONLY))
+        max_commit_age = option_as_int(Config.MAX_COMMIT_AGE, 0)
+        response_cache_entries = option_as_int(Config.RESPONSE_CACHE_ENTRIES, 1000)
+        max_response_size = option_as_int(Config.MAX_RESPONSE_SIZE, 16 * 1024 * 1024)
+        plan_file = get_either_from_yaml_or_from_secret_store(Config.PLAN_FILE)
+        execute_plan = option_as_bool(get_either_from_yaml_or_from_secret_store(Config.EXECUTE_PLAN))
 
-        return cls(drone_api, drone_token, gogs_api, gogs_token, from_, source, dry_run, verbose)
+        return cls(drone_api=drone_api, drone_token=drone_token, gogs_api=gogs_api, gogs_token=gogs_token,
+                   from_=from_, source=source, dry_run=dry_run, verbose=verbose, concurrency=concurrency,
+                   cache_dir=cache_dir, cache_max_age=cache_max_age, cache_max_entries=cache_max_entries,
+                   state_max_age=state_max_age, token_max_age=token_max_age, prefetch_tokens=prefetch_tokens,
+                   dockerfile_patterns=dockerfile_patterns,
+                   collapse_triggers=collapse_triggers, cascade=cascade, cascade_image=cascade_image,
+                   cascade_timeout=cascade_timeout, cascade_poll_interval=cascade_poll_interval,
+                   server_url=server_url, server_token=server_token, server_port=server_port,
+                   server_secret=server_secret, server_refresh_interval=server_refresh_interval,
+                   metrics_file=metrics_file, metrics_textfile=metrics_textfile, request_timeout=request_timeout,
+                   request_retries=request_retries, run_deadline=run_deadline, hedge_after_millis=hedge_after_millis,
+                   rate_limit=rate_limit, max_running_builds=max_running_builds,
+                   build_poll_interval=build_poll_interval, coalesce_window=coalesce_window,
+                   include_repos=include_repos, exclude_repos=exclude_repos, include_branches=include_branches,
+                   exclude_branches=exclude_branches, active_only=active_only, max_commit_age=max_commit_age,
+                   response_cache_entries=response_cache_entries, max_response_size=max_response_size,
+                   plan_file=plan_file, execute_plan=execute_plan)
 
 
 def validate(config: Config) -> None:
+    if config.server_url:
+        validate_url(config.server_url, Config.SERVER_URL)
+    else:
+        validate_clients(config)
+
+    # an executed plan brings its own images and source
+    if not config.execute_plan:
+        validate_value(config.from_, Config.FROM, mandatory=True)
+
+        validate_drone_value(config.source, Config.SOURCE)
+
+    validate_positive(config.concurrency, Config.CONCURRENCY)
+    validate_positive(config.cache_max_age, Config.CACHE_MAX_AGE)
+    validate_positive(config.cache_max_entries, Config.CACHE_MAX_ENTRIES)
+    validate_positive(config.state_max_age, Config.STATE_MAX_AGE)
+    validate_positive(config.token_max_age, Config.TOKEN_MAX_AGE)
+    validate_positive(config.cascade_timeout, Config.CASCADE_TIMEOUT)
+    validate_positive(config.cascade_poll_interval, Config.CASCADE_POLL_INTERVAL)
+    validate_requests(config)
+    validate_coalescing(config)
+    validate_filters(config)
+    validate_plan(config)
+
+
+def validate_service(config: Config) -> None:
+    validate_clients(config)
+
+    validate_value(config.server_token, Config.SERVER_TOKEN, mandatory=False,
+                   additional_message="Without the token, anyone can trigger builds via the service.")
+    validate_value(config.server_secret, Config.SERVER_SECRET, mandatory=False,
+                   additional_message="Without the secret, the signature of Gogs webhooks won't be verified.")
+
+    validate_positive(config.concurrency, Config.CONCURRENCY)
+    validate_positive(config.cache_max_age, Config.CACHE_MAX_AGE)
+    validate_positive(config.cache_max_entries, Config.CACHE_MAX_ENTRIES)
+    validate_positive(config.state_max_age, Config.STATE_MAX_AGE)
+    validate_positive(config.token_max_age, Config.TOKEN_MAX_AGE)
+    validate_positive(config.server_port, Config.SERVER_PORT)
+    validate_requests(config)
+    validate_coalescing(config)
+    validate_filters(config)
+
+
+def validate_clients(config: Config) -> None:
     validate_value(config.drone_api, Config.DRONE_API, mandatory=True)
     validate_url(config.drone_api, Config.DRONE_API)
 
@@ -51,10 +216,6 @@ def validate(config: Config) -> None:
     validate_value(config.gogs_token, Config.GOGS_TOKEN, mandatory=False,
                    additional_message="Without the token, API calls to gogs won't be authenticated.")
 
-    validate_value(config.from_, Config.FROM, mandatory=True)
-
-    validate_drone_value(config.source, Config.SOURCE)
-
 
 def validate_value(value: str, option: str, mandatory: bool = False, additional_message: str = "") -> None:
     if not value:
@@ -80,3 +241,54 @@ def validate_drone_value(value: str, option: str) -> None:
     if not value:
         l.error("Mandatory environment variable {} is missing.".format(option))
         raise SystemExit()
+
+
+def validate_requests(config: Config) -> None:
+    validate_positive(config.request_timeout, Config.REQUEST_TIMEOUT)
+    validate_not_negative(config.request_retries, Config.REQUEST_RETRIES)
+    validate_not_negative(config.run_deadline, Config.RUN_DEADLINE)
+    validate_not_negative(config.hedge_after_millis, Config.HEDGE_AFTER_MILLIS)
+    validate_not_negative(config.rate_limit, Config.RATE_LIMIT)
+    validate_not_negative(config.max_running_builds, Config.MAX_RUNNING_BUILDS)
+    validate_positive(config.build_poll_interval, Config.BUILD_POLL_INTERVAL)
+    validate_not_negative(config.response_cache_entries, Config.RESPONSE_CACHE_ENTRIES)
+    validate_positive(config.max_response_size, Config.MAX_RESPONSE_SIZE)
+
+
+def validate_coalescing(config: Config) -> None:
+    validate_not_negative(config.coalesce_window, Config.COALESCE_WINDOW)
+    if config.coalesce_window and not config.cache_dir:
+        l.error("Coalescing triggers requires %s, the ledger of triggered builds is kept there.",
+                Config.CACHE_DIR.lower())
+        raise SystemExit()
+
+
+def validate_plan(config: Config) -> None:
+    if config.execute_plan and not config.plan_file:
+        l.error("Executing a plan requires %s, the plan is read from there.", Config.PLAN_FILE.lower())
+        raise SystemExit()
+    if config.plan_file and (config.cascade or config.server_url):
+        l.error("Plans are neither supported in cascade mode nor via %s.", Config.SERVER_URL.lower())
+        raise SystemExit()
+
+
+def validate_filters(config: Config) -> None:
+    validate_not_negative(config.max_commit_age, Config.MAX_COMMIT_AGE)
+    for pattern in config.include_branches + config.exclude_branches:
+        try:
+            compile_branch_pattern(pattern)
+        except re.error as e:
+            l.error("Invalid branch pattern specified: %s, %s", pattern, e)
+            raise SystemExit()
+
+
+def validate_positive(value: int, option: str) -> None:
+    if value < 1:
+        l.error("Invalid value specified as %s: %s, must be at least 1.", option.lower(), value)
+        raise SystemExit()
+
+
+def validate_not_negative(value: int, option: str) -> None:
+    if value < 0:
+        l.error("Invalid value specified as %s: %s, must not be negative.", option.lower(), value)
+        raise SystemExit()
@@ -0,0 +1,154 @@
+import fnmatch
+import re
+from typing import Dict, List, Optional, Tuple
+
+DEFAULT_REGISTRY = "docker.io"
+OFFICIAL_NAMESPACE = "library"
+
+DIRECTIVE_REGEX = re.compile(r"^#\s*(\w+)\s*=\s*(.*?)\s*$")
+VARIABLE_REGEX = re.compile(r"\$(?:{(\w+)(?::([-+])([^}]*))?}|(\w+))")
+FROM_REGEX = re.compile(br"^\s*FROM\s", re.MULTILINE | re.IGNORECASE)
+# Dockerfiles are read completely up to this size, larger ones only up to the first complete chunk with a FROM
+# instruction, later build stages of huge generated Dockerfiles are not considered
+READ_AHEAD = 64 * 1024
+
+
+def read_enough(prefix: bytes) -> bool:
+    return len(prefix) >= READ_AHEAD and FROM_REGEX.search(prefix) is not None
+
+
+def logical_lines(dockerfile: str) -> List[str]:
+    escape = "\\"
+    lines = dockerfile.splitlines()
+    # parser directives are only recognized before the first instruction, comment or empty line
+    for line in lines:
+        directive = DIRECTIVE_REGEX.match(line)
+        if not directive:
+            break
+        if directive.group(1).lower() == "escape" and directive.group(2) in ("\\", "`"):
+            escape = directive.group(2)
+
+    instructions = []
+    current = ""
+    for line in lines:
+        stripped = line.strip()
+        if stripped.startswith("#") or (current and not stripped):
+            continue
+        if stripped.endswith(escape):
+            current += stripped[:-1] + " "
+        else:
+            current += stripped
+            if current.strip():
+                instructions.append(current.strip())
+            current = ""
+    if current.strip():
+        instructions.append(current.strip())
+    return instructions
+
+
+def substitute(value: str, variables: Dict[str, str]) -> str:
+    def replace(match) -> str:
+        name = match.group(1) or match.group(4)
+        current = variables.get(name, "")
+        if match.group(2) == "-":
+            return current or match.group(3)
+        if match.group(2) == "+":
+            return match.group(3) if current else ""
+        return current
+
+    return VARIABLE_REGEX.sub(replace, value)
+
+
+def parse_arg(arguments: str, variables: Dict[str, str]) -> None:
+    for argument in arguments.split():
+        name, _, default = argument.partition("=")
+        variables[name] = substitute(default.strip("\"'"), variables)
+
+
+def parse_from(arguments: str, variables: Dict[str, str]) -> Tuple[str, str]:
+    tokens = [token for token in arguments.split() if not token.startswith("--")]
+    if not tokens:
+        return "", ""
+    image = substitute(tokens[0], variables)
+    alias = tokens[2].lower() if len(tokens) >= 3 and tokens[1].lower() == "as" else ""
+    return image, alias
+
+
+def parse_from_images(dockerfile: str) -> List[str]:
+    # the normalized images of all FROM instructions which do not refer to an earlier build stage
+    global_variables = {}  # type: Dict[str, str]
+    aliases = set()
+    images = []
+    seen_from = False
+    for instruction in logical_lines(dockerfile):
+        keyword, _, arguments = instruction.partition(" ")
+        keyword = keyword.upper()
+        # only ARGs before the first FROM may be used within FROM instructions
+        if keyword == "ARG" and not seen_from:
+            parse_arg(arguments, global_variables)
+        elif keyword == "FROM":
+            seen_from = True
+            image, alias = parse_from(arguments, global_variables)
+            if image and image.lower() not in aliases and image.lower() != "scratch":
+                normalized = normalize_image(image)
+                if normalized not in images:
+                    images.append(normalized)
+            if alias:
+                aliases.add(alias)
+    return images
+
+
+def normalize_image(image: str) -> str:
+    # e.g. "base:alpine" -> "docker.io/library/base:alpine", "example.org:5000/base" -> "example.org:5000/base:latest"
+    name, _, digest = image.strip().partition("@")
+    tag = ""
+    last_slash = name.rfind("/")
+    if name.rfind(":") > last_slash:
+        name, _, tag = name.rpartition(":")
+
+    components = name.lower().split("/")
+    if len(components) == 1 or not ("." in components[0] or ":" in components[0] or components[0] == "localhost"):
+        components.insert(0, DEFAULT_REGISTRY)
+    if components[0] in ("index.docker.io", "registry-1.docker.io"):
+        components[0] = DEFAULT_REGISTRY
+    if components[0] == DEFAULT_REGISTRY and len(components) == 2:
+        components.insert(1, OFFICIAL_NAMESPACE)
+
+    reference = "/".join(components)
+    if tag or not digest:
+        reference += ":" + (tag or "latest")
+    if digest:
+        reference += "@" + digest
+    return reference
+
+
+def repository_of(image: str) -> str:
+    # the normalized image without tag and digest
+    reference = normalize_image(image).partition("@")[0]
+    return reference.rpartition(":")[0] if reference.rfind(":") > reference.rfind("/") else reference
+
+
+def is_pattern(from_: str) -> bool:
+    return any(c in from_ for c in "*?[")
+
+
+def normalize_pattern(pattern: str) -> str:
+    # normalized like an image, but a pattern without tag matches every tag, e.g. "base*" -> "docker.io/library/base*:*"
+    normalized = normalize_image(pattern)
+    if pattern.rfind(":") > pattern.rfind("/") or "@" in pattern:
+        return normalized
+    return normalized.rpartition(":")[0] + ":*"
+
+
+def image_matches(image: str, from_: str) -> bool:
+    # a pinned digest still refers to the tag it was taken from, unless the wanted image is pinned itself
+    image = normalize_image(image)
+    if is_pattern(from_):
+        return fnmatch.fnmatchcase(image if "@" in from_ else image.partition("@")[0], normalize_pattern(from_))
+    from_ = normalize_image(from_)
+    return image == from_ or (image.startswith(from_ + "@") and "@" not in from_)
+
+
+def matching_from(images: List[str], froms: List[str]) -> Optional[str]:
+    # the first of the wanted images or patterns which one of the images matches
+    return next((from_ for from_ in froms if any(image_matches(image, from_) for image in images)), None)
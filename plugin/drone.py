@@ -1,7 +1,14 @@
 import json
 import logging as l
-from typing import Union, Dict, NamedTuple
+import re
+import threading
+import time
+from contextlib import contextmanager
+from typing import Callable, Dict, Iterator, NamedTuple, Optional, List, Set, Tuple
 
+from cache import TriggerLedger
+from filters import TargetFilter
+from metrics import Metrics
 from remote import Client, Requester, ClientException
 from repository import Repo, Branch
 
@@ -10,8 +17,28 @@ from remote import Json
 from repository import Repos, Branches
 
 
-BuildTrigger = NamedTuple("BuildTrigger", [("branches", Branches), ("token", str)])
+# matched maps the names of the branches to the wanted image their Dockerfile matched, if known
+BuildTrigger = NamedTuple("BuildTrigger", [("branches", Branches), ("token", str), ("matched", Dict[str, str])])
 BuildTriggers = Dict[Repo, BuildTrigger]
+BuildsOfRepos = Dict[Repo, List[int]]
+TokenRefresher = Callable[[Repo], Optional[str]]
+
+PLACEHOLDER_REGEX = re.compile(r"{(\w+)}")
+
+
+class JsonTemplate(object):
+    # serialized once, rendering only inserts the JSON encoded values of the "{placeholders}" between constant parts
+    def __init__(self, template: Json) -> None:
+        parts = PLACEHOLDER_REGEX.split(json.dumps(template))
+        self.literals = parts[0::2]
+        self.names = parts[1::2]
+
+    def render(self, **kwargs: str) -> bytes:
+        rendered = [self.literals[0]]
+        for name, literal in zip(self.names, self.literals[1:]):
+            rendered.append(json.dumps(kwargs[name])[1:-1])
+            rendered.append(literal)
+        return "".join(rendered).encode()
 
 
 class DroneClient(Client):
@@ -32,16 +59,35 @@ class DroneClient(Client):
             "username": "drone"
         }
     }
+    TRIGGER_BODY = JsonTemplate(TRIGGER_TEMPLATE)
+
+    NAME = "drone"
 
-    def __init__(self, requester: Requester, api_url: str, token: str = None) -> None:
-        super().__init__(requester, api_url)
+    def __init__(self, requester: Requester, api_url: str, token: str = None, metrics: Metrics = None,
+                 max_running_builds: int = 0, poll_interval: int = 15, ledger: TriggerLedger = None) -> None:
+        super().__init__(requester, api_url, metrics=metrics)
         if token:
             self.add_header("Authorization", token)
+        self.ledger = ledger
+        self.max_running_builds = max_running_builds
+        self.poll_interval = poll_interval
+        # the builds this client started which were unfinished when last polled, and builds whose hook request
+        # is still on its way, other builds in Drone's queue (e.g. the upstream build running this plugin) do not count
+        self._running = set()  # type: Set[Tuple[Repo, int]]
+        self._starting = 0
+        self._polling = False
+        self._capacity = threading.Condition()
 
-    def retrieve_repos(self) -> Repos:
+    def retrieve_repos(self, targets: TargetFilter = None) -> Repos:
+        return list(self.iterate_repos(targets))
+
+    def iterate_repos(self, targets: TargetFilter = None) -> Iterator[Repo]:
         try:
-            doc = self.request_json("/user/repos")
-            return [Repo(r["owner"], r["name"]) for r in doc] if doc else []
+            for doc in self.request_pages("/user/repos"):
+                for r in doc or []:
+                    repo = Repo(r["owner"], r["name"])
+                    if not targets or targets.accepts_repo(repo, r.get("active", True)):
+                        yield repo
         except ClientException as e:
             l.error("Unable to retrieve Drone repositories: %s", e)
             raise SystemExit(1)
@@ -56,35 +102,172 @@ class DroneClient(Client):
         else:
             l.error("%s: %s", not_triggered_message, e)
 
-    def trigger_branch_build(self, repo: Repo, branch: Branch, source: Repo) -> int:
-        hook_data = json_format(DroneClient.TRIGGER_TEMPLATE,
-                                owner=repo.owner, name=repo.name, branch=branch.name, commit=branch.sha1,
-                                source=source.full_name)
+    HOOK_HEADERS = {"Content-Type": "application/json; charset=utf-8", "X-Gogs-Event": "push"}
+    UNFINISHED_STATES = ("pending", "running", "blocked")
+
+    def trigger_branch_build(self, repo: Repo, branch: Branch, source: Repo, token: str,
+                             image: str = None) -> Optional[int]:
         try:
-            doc = self.request_json("/hook", json.dumps(hook_data).encode())
-            l.debug("Triggered build #%s for %s on branch %s", doc["number"], repo.full_name, branch.name)
-            return 1
+            return self.send_branch_build(repo, branch, source, token, image)
         except ClientException as e:
             self.unable_to_trigger(e, repo.full_name)
-            return 0
+            return None
+
+    def send_branch_build(self, repo: Repo, branch: Branch, source: Repo, token: str, image: str = None) -> int:
+        upstream = "{} ({})".format(source.full_name, image) if image else source.full_name
+        hook_data = DroneClient.TRIGGER_BODY.render(owner=repo.owner, name=repo.name, branch=branch.name,
+                                                    commit=branch.sha1, source=upstream)
+        doc = self.request_json("/hook", hook_data, dict(DroneClient.HOOK_HEADERS, Authorization=token))
+        l.debug("Triggered build #%s for %s on branch %s", doc["number"], repo.full_name, branch.name)
+        return doc["number"]
+
+    @staticmethod
+    def collapse_branches(repo: Repo, branches: Branches) -> Branches:
+        branches_of_commits = {}
+        for branch in branches:
+            if branch.sha1 in branches_of_commits:
+                l.debug("Not triggering build for %s on branch %s, commit %s is already built for branch %s",
+                        repo.full_name, branch.name, branch.sha1, branches_of_commits[branch.sha1].name)
+            else:
+                branches_of_commits[branch.sha1] = branch
+        return list(branches_of_commits.values())
 
-    def trigger_builds(self, triggers: BuildTriggers, source: Repo) -> int:
-        self.add_header("Content-Type", "application/json; charset=utf-8")
-        self.add_header("X-Gogs-Event", "push")
-        builds_triggered = 0
+    def start_builds(self, triggers: BuildTriggers, source: Repo, collapse: bool = False,
+                     refresh_token: TokenRefresher = None) -> BuildsOfRepos:
+        # a token rejected by Drone may merely be outdated, it is refreshed once per repo before giving up
+        builds_of_repos = {}
         for repo, trigger in triggers.items():
-            self.add_header("Authorization", trigger.token)
-            for branch in trigger.branches:
-                builds_triggered += self.trigger_branch_build(repo, branch, source)
-        return builds_triggered
-
-
-def json_format(original: Json, **kwargs: Union[str, Dict]) -> Json:
-    if isinstance(original, list):
-        return [json_format(value, **kwargs) for value in original]
-    elif isinstance(original, dict):
-        return {key.format(**kwargs): json_format(value, **kwargs) for key, value in original.items()}
-    elif isinstance(original, str):
-        return original.format(**kwargs)
-    else:
-        return original
+            branches = self.collapse_branches(repo, trigger.branches) if collapse else trigger.branches
+            token, refreshable = trigger.token, refresh_token is not None
+            for branch in branches:
+                image = trigger.matched.get(branch.name)
+                if self.ledger and not self.ledger.claim(repo, branch, source):
+                    l.debug("Not triggering build for %s on branch %s, commit %s was already triggered for %s",
+                            repo.full_name, branch.name, branch.sha1, source.full_name)
+                    continue
+                with self.build_slot() as started:
+                    try:
+                        number = self.send_branch_build(repo, branch, source, token, image)
+                    except ClientException as e:
+                        fresh_token = None
+                        if refreshable and e.getcode() == 400:
+                            fresh_token = refresh_token(repo)
+                            refreshable = False
+                        if fresh_token and fresh_token != token:
+                            l.info("Drone rejected the token of %s, retrying with a refetched one.", repo.full_name)
+                            token = fresh_token
+                            number = self.trigger_branch_build(repo, branch, source, token, image)
+                        else:
+                            self.unable_to_trigger(e, repo.full_name)
+                            number = None
+                    if number is not None:
+                        started.add((repo, number))
+                if number is not None:
+                    builds_of_repos.setdefault(repo, []).append(number)
+                elif self.ledger:
+                    self.ledger.release(repo, branch, source)
+        return builds_of_repos
+
+    def trigger_builds(self, triggers: BuildTriggers, source: Repo, collapse: bool = False,
+                       refresh_token: TokenRefresher = None) -> int:
+        return sum(len(builds) for builds in self.start_builds(triggers, source, collapse, refresh_token).values())
+
+    @contextmanager
+    def build_slot(self) -> Iterator[Set[Tuple[Repo, int]]]:
+        # yields the set to add the started build to, it counts as running from then on
+        started = set()  # type: Set[Tuple[Repo, int]]
+        if not self.max_running_builds:
+            yield started
+            return
+        self.wait_for_capacity()
+        try:
+            yield started
+        finally:
+            with self._capacity:
+                self._starting -= 1
+                self._running.update(started)
+                self._capacity.notify_all()
+
+    def at_capacity(self) -> bool:
+        return len(self._running) + self._starting >= self.max_running_builds
+
+    def wait_for_capacity(self) -> None:
+        # one thread at a time polls the builds, the others wait for its result, the lock is neither held
+        # while Drone is asked nor while waiting for builds to finish
+        while True:
+            with self._capacity:
+                while self.at_capacity() and self._polling:
+                    self._capacity.wait()
+                if not self.at_capacity():
+                    self._starting += 1
+                    return
+                self._polling = True
+                running = list(self._running)
+
+            finished = set()  # type: Set[Tuple[Repo, int]]
+            try:
+                finished = self.finished_builds(running)
+            finally:
+                with self._capacity:
+                    self._polling = False
+                    self._running.difference_update(finished)
+                    self._capacity.notify_all()
+            if not finished:
+                l.debug("Waiting for capacity, %s builds are pending or running.", len(running))
+                with self._capacity:
+                    self._capacity.wait(self.poll_interval)
+
+    def finished_builds(self, builds: List[Tuple[Repo, int]]) -> Set[Tuple[Repo, int]]:
+        finished = set()
+        for repo, number in builds:
+            try:
+                status = self.retrieve_build_status(repo, number)
+            except ClientException as e:
+                # rather exceed the limit than wait for a build which cannot be seen, e.g. because it was deleted
+                l.warning("Not counting build #%s of %s as running, its status could not be retrieved: %s",
+                          number, repo.full_name, e)
+                status = None
+            if status not in DroneClient.UNFINISHED_STATES:
+                finished.add((repo, number))
+        return finished
+
+    def retrieve_build_status(self, repo: Repo, number: int) -> str:
+        doc = self.request_json("/repos/{}/builds/{}".format(repo.full_name, number))
+        return doc["status"]
+
+    def wait_for_builds(self, builds_of_repos: BuildsOfRepos, timeout: int, interval: int) -> Set[Repo]:
+        # returns the repos whose builds all succeeded
+        deadline = time.monotonic() + timeout
+        pending = {(repo, number) for repo, numbers in builds_of_repos.items() for number in numbers}
+        failed = set()
+        while pending:
+            if self.requester.expired():
+                l.warning("Gave up waiting for builds, the run exceeded its deadline: %s",
+                          ", ".join("{}#{}".format(repo.full_name, number) for repo, number in sorted(pending)))
+                failed.update(repo for repo, _ in pending)
+                break
+            for repo, number in sorted(pending):
+                if self.requester.expired():
+                    break
+                try:
+                    status = self.retrieve_build_status(repo, number)
+                except ClientException as e:
+                    l.warning("Unable to retrieve status of build #%s of %s: %s", number, repo.full_name, e)
+                    continue
+                if status not in DroneClient.UNFINISHED_STATES:
+                    pending.discard((repo, number))
+                    l.debug("Build #%s of %s finished with status %s", number, repo.full_name, status)
+                    if status != "success":
+                        failed.add(repo)
+            if pending and time.monotonic() + interval > deadline:
+                l.warning("Gave up waiting for builds: %s",
+                          ", ".join("{}#{}".format(repo.full_name, number) for repo, number in sorted(pending)))
+                failed.update(repo for repo, _ in pending)
+                break
+            if pending:
+                delay = interval
+                if self.requester.deadline is not None:
+                    delay = min(delay, max(0.0, self.requester.deadline - time.monotonic()))
+                time.sleep(delay)
+        return set(builds_of_repos) - failed
+
@@ -0,0 +1,78 @@
+import logging as l
+import threading
+from collections import deque
+from concurrent.futures import Future, ThreadPoolExecutor
+from typing import Callable, Deque, Iterable, Iterator, List, TypeVar
+
+T = TypeVar("T")
+R = TypeVar("R")
+
+
+class BufferedLogs(l.Filter):
+    # holds back records logged by worker threads, so that they can be replayed in submission order
+    def __init__(self) -> None:
+        super().__init__()
+        self._local = threading.local()
+
+    def filter(self, record: l.LogRecord) -> bool:
+        buffer = getattr(self._local, "buffer", None)
+        if buffer is None:
+            return True
+        buffer.append(record)
+        return False
+
+    def capture(self, func: Callable[[T], R], item: T) -> "Captured":
+        self._local.buffer = []
+        try:
+            return Captured(func(item), self._local.buffer, None)
+        except BaseException as e:
+            return Captured(None, self._local.buffer, e)
+        finally:
+            self._local.buffer = None
+
+
+class Captured(object):
+    def __init__(self, result, records: List[l.LogRecord], error: BaseException = None) -> None:
+        self.result = result
+        self.records = records
+        self.error = error
+
+    def unwrap(self):
+        logger = l.getLogger()
+        for record in self.records:
+            logger.handle(record)
+        if self.error:
+            raise self.error
+        return self.result
+
+
+class Executor(object):
+    # items submitted ahead of the one whose result is yielded next, per worker
+    WINDOW_PER_WORKER = 2
+
+    def __init__(self, workers: int = 1) -> None:
+        self.workers = max(1, workers or 1)
+
+    def map(self, func: Callable[[T], R], items: Iterable[T]) -> Iterator[R]:
+        # results and the records logged while computing them are yielded in the order of items,
+        # so the output of a run does not depend on the number of workers. Items are consumed lazily and only
+        # a bounded window of them is in flight, so a long stream of items is processed in constant memory.
+        if self.workers == 1:
+            yield from map(func, items)
+            return
+
+        logs = BufferedLogs()
+        root = l.getLogger()
+        root.addFilter(logs)
+        try:
+            with ThreadPoolExecutor(max_workers=self.workers) as pool:
+                window = self.workers * self.WINDOW_PER_WORKER
+                futures = deque()  # type: Deque[Future]
+                for item in items:
+                    futures.append(pool.submit(logs.capture, func, item))
+                    if len(futures) >= window:
+                        yield futures.popleft().result().unwrap()
+                while futures:
+                    yield futures.popleft().result().unwrap()
+        finally:
+            root.removeFilter(logs)
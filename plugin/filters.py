@@ -0,0 +1,73 @@
+import fnmatch
+import logging as l
+import re
+import threading
+import time
+from datetime import datetime
+from typing import Dict, List, Optional, Pattern
+
+from repository import Repo
+
+TIMESTAMP_REGEX = re.compile(r"^(\d{4}-\d{2}-\d{2}T\d{2}:\d{2}:\d{2})(?:\.\d+)?(Z|[+-]\d{2}:?\d{2})$")
+
+
+class TargetFilter(object):
+    # Decides which repos and branches are considered at all. Repos are filtered while Drone lists them and branches
+    # while Gogs lists them, so excluded targets never cause a request of their own.
+    def __init__(self, include_repos: List[str] = None, exclude_repos: List[str] = None,
+                 include_branches: List[str] = None, exclude_branches: List[str] = None, active_only: bool = False,
+                 max_commit_age: int = 0) -> None:
+        self.include_repos = include_repos or []
+        self.exclude_repos = exclude_repos or []
+        self.include_branches = [compile_branch_pattern(p) for p in include_branches or []]
+        self.exclude_branches = [compile_branch_pattern(p) for p in exclude_branches or []]
+        self.active_only = active_only
+        self.max_commit_age = max_commit_age
+        self.skipped = {}  # type: Dict[str, int]
+        self._lock = threading.Lock()
+
+    def accepts_repo(self, repo: Repo, active: bool = True) -> bool:
+        if self.active_only and not active:
+            return self.skip("inactive repos")
+        if self.include_repos and not any(fnmatch.fnmatchcase(repo.full_name, p) for p in self.include_repos):
+            return self.skip("repos not included")
+        if any(fnmatch.fnmatchcase(repo.full_name, p) for p in self.exclude_repos):
+            return self.skip("excluded repos")
+        return True
+
+    def accepts_branch(self, name: str, committed: Optional[float] = None) -> bool:
+        if self.include_branches and not any(p.match(name) for p in self.include_branches):
+            return self.skip("branches not included")
+        if any(p.match(name) for p in self.exclude_branches):
+            return self.skip("excluded branches")
+        if self.max_commit_age and committed is not None and committed < time.time() - self.max_commit_age:
+            return self.skip("stale branches")
+        return True
+
+    def skip(self, reason: str) -> bool:
+        with self._lock:
+            self.skipped[reason] = self.skipped.get(reason, 0) + 1
+        return False
+
+    def log_savings(self) -> None:
+        # every skipped repo saves at least listing its branches, every skipped branch at least one Dockerfile
+        with self._lock:
+            skipped = sorted(self.skipped.items())
+        for reason, count in skipped:
+            l.debug("Skipped %s %s, saving at least as many requests.", count, reason)
+
+
+def compile_branch_pattern(pattern: str) -> Pattern:
+    # "/regex/" is a regular expression, anything else a glob like "dependabot/*"
+    if len(pattern) > 1 and pattern.startswith("/") and pattern.endswith("/"):
+        return re.compile(pattern[1:-1])
+    return re.compile(fnmatch.translate(pattern))
+
+
+def parse_timestamp(timestamp: str) -> Optional[float]:
+    # RFC 3339 as used by the Gogs API, e.g. "2017-06-01T12:00:00Z" or "2017-06-01T14:00:00+02:00"
+    match = TIMESTAMP_REGEX.match(timestamp or "")
+    if not match:
+        return None
+    offset = "+0000" if match.group(2) == "Z" else match.group(2).replace(":", "")
+    return datetime.strptime(match.group(1) + offset, "%Y-%m-%dT%H:%M:%S%z").timestamp()
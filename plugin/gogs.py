@@ -1,8 +1,13 @@
 import logging as l
 import urllib.parse
-import re
-
-from remote import Client, Requester, ClientException, ExceptionWithReason
+import fnmatch
+from typing import List, Optional, Dict
+
+from cache import DockerfileCache, StateStore
+from dockerfile import parse_from_images, read_enough
+from filters import TargetFilter, parse_timestamp
+from metrics import Metrics
+from remote import Client, Requester, ClientException, ExceptionWithReason, HTTPStatusException
 from repository import Repo, Branch
 
 # types
@@ -11,27 +16,91 @@ from remote import Json
 
 
 class GogsClient(Client):
-    def __init__(self, requester: Requester, api_url: str, token: str) -> None:
-        super().__init__(requester, api_url)
+    NAME = "gogs"
+    DOCKERFILE_NAMES = ("Dockerfile", "dockerfile")
+
+    def __init__(self, requester: Requester, api_url: str, token: str, cache: DockerfileCache = None,
+                 dockerfile_patterns: List[str] = None, metrics: Metrics = None) -> None:
+        super().__init__(requester, api_url, metrics=metrics)
+        self.cache = cache
+        self.dockerfile_patterns = dockerfile_patterns
         if token:
             self.add_header("Authorization", "token {}".format(token))
 
-    def retrieve_branches(self, repo: Repo) -> Branches:
-        doc = self.request_json("/repos/{}/branches".format(repo.full_name))
-        return [Branch(branch["name"], branch["commit"]["id"]) for branch in doc]
+    def retrieve_branches(self, repo: Repo, targets: TargetFilter = None) -> Branches:
+        branches = []
+        for doc in self.request_pages("/repos/{}/branches".format(repo.full_name)):
+            for branch in doc:
+                commit = branch["commit"]
+                if not targets or targets.accepts_branch(branch["name"], parse_timestamp(commit.get("timestamp"))):
+                    branches.append(Branch(branch["name"], commit["id"]))
+        return branches
+
+    @staticmethod
+    def blob_path(repo: Repo, sha1: str, file: str) -> str:
+        # by commit, not by branch name: a branch moving meanwhile must not put another commit's file into the cache
+        return "/repos/{}/raw/{}/{}".format(repo.full_name, sha1, file)
 
-    def retrieve_blob(self, repo: Repo, branch_name: str, file: str) -> str:
-        path = "/repos/{}/raw/{}/{}".format(repo.full_name, branch_name, file)
-        return self.request_raw(path)
+    def retrieve_blob(self, repo: Repo, sha1: str, file: str) -> str:
+        # a Dockerfile is only needed up to its FROM instructions
+        return self.request_raw(self.blob_path(repo, sha1, file), enough=read_enough)
+
+    def retrieve_cached_blob(self, repo: Repo, branch: Branch, file: str) -> str:
+        if not self.cache:
+            return self.retrieve_blob(repo, branch.sha1, file)
+
+        cached = self.cache.get(repo, branch.sha1, file)
+        if cached:
+            if cached.content is None:
+                url = self.api_url + self.blob_path(repo, branch.sha1, file)
+                raise ClientException("Cached client error") from HTTPStatusException(404, url, "Not Found")
+            return cached.content
 
-    def retrieve_dockerfile(self, repo: Repo, branch: Branch) -> str:
         try:
-            return self.retrieve_blob(repo, branch.name, "Dockerfile")
+            content = self.retrieve_blob(repo, branch.sha1, file)
         except ClientException as e:
             if e.getcode() == 404:
-                return self.retrieve_blob(repo, branch.name, "dockerfile")
-            else:
-                raise
+                self.cache.put(repo, branch.sha1, file, None)
+            raise
+        self.cache.put(repo, branch.sha1, file, content)
+        return content
+
+    def retrieve_tree(self, repo: Repo, branch: Branch) -> List[str]:
+        # Gitea pages recursive trees and marks every page but the last one as truncated, a truncated tree without
+        # pages is incomplete, as is one of a server without the trees endpoint, both must not pass as "no Dockerfile"
+        paths = []  # type: List[str]
+        page = 1
+        while True:
+            path = "/repos/{}/git/trees/{}?recursive=1&page={}".format(repo.full_name, branch.sha1, page)
+            try:
+                doc = self.request_json(path)
+            except ClientException as e:
+                raise IncompleteTreeException("Unable to list the tree of {}".format(repo.full_name)) from e
+            entries = doc.get("tree") or []
+            paths.extend(entry["path"] for entry in entries if entry.get("type") == "blob")
+            if not doc.get("truncated"):
+                return paths
+            if doc.get("page") != page or not entries:
+                raise IncompleteTreeException("The tree of {} at {} is truncated".format(repo.full_name, branch.sha1))
+            page += 1
+
+    def retrieve_dockerfiles(self, repo: Repo, branch: Branch) -> Dict[str, str]:
+        if not self.dockerfile_patterns:
+            return {"Dockerfile": self.retrieve_dockerfile(repo, branch)}
+
+        # one listing of the tree instead of probing every candidate name, only existing blobs are fetched
+        paths = [path for path in self.retrieve_tree(repo, branch)
+                 if any(fnmatch.fnmatchcase(path, pattern) for pattern in self.dockerfile_patterns)]
+        return {path: self.retrieve_cached_blob(repo, branch, path) for path in sorted(paths)}
+
+    def retrieve_dockerfile(self, repo: Repo, branch: Branch) -> str:
+        for file in self.DOCKERFILE_NAMES[:-1]:
+            try:
+                return self.retrieve_cached_blob(repo, branch, file)
+            except ClientException as e:
+                if e.getcode() != 404:
+                    raise
+        return self.retrieve_cached_blob(repo, branch, self.DOCKERFILE_NAMES[-1])
 
     @staticmethod
     def parse_hook_token(doc: Json) -> str:
@@ -56,30 +125,59 @@ class UnableToFindDroneHookException(ExceptionWithReason):
     pass
 
 
-class DockerImageSearcher(object):
-    FROM_REGEX = re.compile("^FROM (.+)$", re.IGNORECASE | re.MULTILINE)
+class IncompleteTreeException(ExceptionWithReason):
+    pass
 
-    def __init__(self, gogs: GogsClient) -> None:
-        self.gogs = gogs
 
-    @staticmethod
-    def has_dockerfile_matching_from_instruction(dockerfile: str, from_: str, ignore_message: str) -> bool:
-        match = DockerImageSearcher.FROM_REGEX.search(dockerfile)
-        if match:
-            image = match.group(1)
-            return image.casefold() == from_.casefold()
-        else:
-            l.warning("%s: FROM instruction is missing.", ignore_message)
-            return False
+class DockerImageSearcher(object):
+    def __init__(self, gogs: GogsClient, state: StateStore = None) -> None:
+        self.gogs = gogs
+        self.state = state
 
-    def has_matching_from_instruction(self, repo: Repo, branch: Branch, from_: str) -> bool:
-        ignore_message = "Ignoring repo {} on branch {}".format(repo.full_name, branch.name)
+    def retrieve_from_images(self, repo: Repo, branch: Branch, ignore_message: str) -> Optional[List[str]]:
+        # None signals a transient error, the result must not be remembered
         try:
-            dockerfile = self.gogs.retrieve_dockerfile(repo, branch)
-            return self.has_dockerfile_matching_from_instruction(dockerfile, from_, ignore_message)
+            dockerfiles = self.gogs.retrieve_dockerfiles(repo, branch)
+        except IncompleteTreeException as e:
+            l.warning("%s: %s", ignore_message, e)
+            return None
         except ClientException as e:
             if e.getcode() == 404:
                 l.warning("%s: No Dockerfile or dockerfile at %s/", ignore_message, e.geturl().rpartition("/")[0])
+                return []
             else:
                 l.warning("%s: Error while retrieving %s: %s", ignore_message, e.geturl(), e)
-            return False
+                return None
+        if not dockerfiles:
+            l.warning("%s: No file matching %s found.", ignore_message, ", ".join(self.gogs.dockerfile_patterns))
+            return []
+
+        images = []
+        for path, dockerfile in dockerfiles.items():
+            images_of_dockerfile = parse_from_images(dockerfile)
+            if not images_of_dockerfile:
+                l.warning("%s: FROM instruction is missing in %s.", ignore_message, path)
+            images.extend(image for image in images_of_dockerfile if image not in images)
+        return images
+
+    def find_from_images_of_commit(self, repo: Repo, branches: List[Branch]) -> List[str]:
+        # all branches point to the same commit, so its Dockerfiles only need to be evaluated once
+        if self.state:
+            stored = [(branch, self.state.get_images(repo, branch)) for branch in branches]
+            evaluated = [(branch, images) for branch, images in stored if images is not None]
+            if evaluated:
+                branch, images = evaluated[0]
+                l.debug("Reusing evaluation of repo %s on branch %s at %s", repo.full_name, branch.name, branch.sha1)
+                for other, images_of_other in stored:
+                    if images_of_other is None:
+                        self.state.put_images(repo, other, images)
+                return images
+
+        ignore_message = "Ignoring repo {} on branch {}".format(repo.full_name, ",".join(b.name for b in branches))
+        images = self.retrieve_from_images(repo, branches[0], ignore_message)
+        if images is None:
+            return []
+        if self.state:
+            for branch in branches:
+                self.state.put_images(repo, branch, images)
+        return images
@@ -0,0 +1,191 @@
+import json
+import os
+import re
+import threading
+import time
+from contextlib import contextmanager
+from typing import Dict, Iterable, Iterator, List, Optional, Tuple, TypeVar
+
+# upper bounds in seconds of the request latency histogram buckets
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, float("inf"))
+
+# paths are reduced to their endpoint, so that e.g. all branch listings end up in the same histogram
+ENDPOINT_PATTERNS = [
+    (re.compile(r"^/repos/[^/]+/[^/]+/raw/.*$"), "/repos/{repo}/raw/{ref}/{path}"),
+    (re.compile(r"^/repos/[^/]+/[^/]+/git/trees/[^/?]+"), "/repos/{repo}/git/trees/{sha}"),
+    (re.compile(r"^/repos/[^/]+/[^/]+/builds/[^/?]+"), "/repos/{repo}/builds/{number}"),
+    (re.compile(r"^/repos/[^/]+/[^/?]+"), "/repos/{repo}"),
+]
+
+RequestKey = Tuple[str, str, str]
+T = TypeVar("T")
+
+
+def endpoint_of(path: str) -> str:
+    for pattern, endpoint in ENDPOINT_PATTERNS:
+        match = pattern.match(path)
+        if match:
+            return endpoint + path[match.end():].split("?")[0]
+    return path.split("?")[0]
+
+
+class Histogram(object):
+    def __init__(self) -> None:
+        self.buckets = [0] * len(LATENCY_BUCKETS)
+        self.count = 0
+        self.sum = 0.0
+
+    def observe(self, value: float) -> None:
+        self.count += 1
+        self.sum += value
+        for i, bound in enumerate(LATENCY_BUCKETS):
+            if value <= bound:
+                self.buckets[i] += 1
+                break
+
+    def cumulative(self) -> List[Tuple[float, int]]:
+        total = 0
+        result = []
+        for bound, count in zip(LATENCY_BUCKETS, self.buckets):
+            total += count
+            result.append((bound, total))
+        return result
+
+
+class RequestStats(object):
+    def __init__(self) -> None:
+        self.latency = Histogram()
+        self.statuses = {}  # type: Dict[str, int]
+        self.bytes = 0
+
+    def to_json(self) -> dict:
+        return {
+            "count": self.latency.count,
+            "seconds": round(self.latency.sum, 6),
+            "bytes": self.bytes,
+            "statuses": dict(sorted(self.statuses.items())),
+            "latency_buckets": {format_bound(bound): count for bound, count in self.latency.cumulative()},
+        }
+
+
+class Metrics(object):
+    def __init__(self) -> None:
+        self.started = time.time()
+        self.phases = {}  # type: Dict[str, float]
+        # the number of threads in each phase and since when it has been entered by any of them
+        self._active = {}  # type: Dict[str, Tuple[int, float]]
+        self.requests = {}  # type: Dict[RequestKey, RequestStats]
+        self._lock = threading.Lock()
+
+    @contextmanager
+    def phase(self, name: str) -> Iterator[None]:
+        # phases overlap across worker threads, a phase lasts from its first thread entering it until the last one
+        # leaving it, so its duration is wall-clock time and not the sum over all threads
+        with self._lock:
+            active, since = self._active.get(name, (0, time.perf_counter()))
+            self._active[name] = (active + 1, since)
+            self.phases.setdefault(name, 0.0)
+        try:
+            yield
+        finally:
+            with self._lock:
+                active, since = self._active.pop(name)
+                if active > 1:
+                    self._active[name] = (active - 1, since)
+                else:
+                    self.phases[name] += time.perf_counter() - since
+
+    def phase_durations(self) -> Dict[str, float]:
+        # including the time phases which are still active have run so far, must be called with self._lock held
+        now = time.perf_counter()
+        durations = dict(self.phases)
+        for name, (_, since) in self._active.items():
+            durations[name] += now - since
+        return durations
+
+    def timed(self, name: str, items: Iterable[T]) -> Iterator[T]:
+        # attributes the time spent producing the items of a lazy stream to a phase, not the time consuming them
+        iterator = iter(items)
+        while True:
+            with self.phase(name):
+                try:
+                    item = next(iterator)
+                except StopIteration:
+                    return
+            yield item
+
+    def observe_request(self, client: str, method: str, path: str, status: Optional[int], seconds: float,
+                        size: int) -> None:
+        key = (client, method, endpoint_of(path))
+        status = str(status) if status else "error"
+        with self._lock:
+            stats = self.requests.get(key)
+            if not stats:
+                stats = self.requests[key] = RequestStats()
+            stats.latency.observe(seconds)
+            stats.statuses[status] = stats.statuses.get(status, 0) + 1
+            stats.bytes += size
+
+    def to_json(self) -> dict:
+        with self._lock:
+            return {
+                "started": self.started,
+                "duration": round(time.time() - self.started, 6),
+                "phases": {name: round(seconds, 6) for name, seconds in self.phase_durations().items()},
+                "requests": [dict(client=client, method=method, endpoint=endpoint, **stats.to_json())
+                             for (client, method, endpoint), stats in sorted(self.requests.items())],
+            }
+
+    def to_prometheus(self) -> str:
+        prefix = "drone_downstream"
+        lines = ["# TYPE {}_run_timestamp_seconds gauge".format(prefix),
+                 "{}_run_timestamp_seconds {}".format(prefix, self.started),
+                 "# TYPE {}_run_duration_seconds gauge".format(prefix),
+                 "{}_run_duration_seconds {:.6f}".format(prefix, time.time() - self.started),
+                 "# TYPE {}_phase_duration_seconds gauge".format(prefix)]
+        with self._lock:
+            for name, seconds in self.phase_durations().items():
+                lines.append('{}_phase_duration_seconds{{phase="{}"}} {:.6f}'.format(prefix, name, seconds))
+
+            lines.append("# TYPE {}_request_duration_seconds histogram".format(prefix))
+            for (client, method, endpoint), stats in sorted(self.requests.items()):
+                labels = 'client="{}",method="{}",endpoint="{}"'.format(client, method, escape_label(endpoint))
+                for bound, count in stats.latency.cumulative():
+                    lines.append('{}_request_duration_seconds_bucket{{{},le="{}"}} {}'.format(
+                        prefix, labels, format_bound(bound), count))
+                lines.append("{}_request_duration_seconds_sum{{{}}} {:.6f}".format(prefix, labels, stats.latency.sum))
+                lines.append("{}_request_duration_seconds_count{{{}}} {}".format(prefix, labels, stats.latency.count))
+
+            lines.append("# TYPE {}_responses_total counter".format(prefix))
+            for (client, method, endpoint), stats in sorted(self.requests.items()):
+                labels = 'client="{}",method="{}",endpoint="{}"'.format(client, method, escape_label(endpoint))
+                for status, count in sorted(stats.statuses.items()):
+                    lines.append('{}_responses_total{{{},status="{}"}} {}'.format(prefix, labels, status, count))
+
+            lines.append("# TYPE {}_response_bytes_total counter".format(prefix))
+            for (client, method, endpoint), stats in sorted(self.requests.items()):
+                labels = 'client="{}",method="{}",endpoint="{}"'.format(client, method, escape_label(endpoint))
+                lines.append("{}_response_bytes_total{{{}}} {}".format(prefix, labels, stats.bytes))
+        return "\n".join(lines) + "\n"
+
+    def export(self, json_path: str = None, prometheus_path: str = None) -> None:
+        if json_path:
+            write_atomically(json_path, json.dumps(self.to_json(), indent=2) + "\n")
+        if prometheus_path:
+            write_atomically(prometheus_path, self.to_prometheus())
+
+
+def format_bound(bound: float) -> str:
+    return "+Inf" if bound == float("inf") else repr(bound)
+
+
+def escape_label(value: str) -> str:
+    return value.replace("\\", "\\\\").replace("\"", "\\\"").replace("\n", "\\n")
+
+
+def write_atomically(path: str, content: str) -> None:
+    # the node exporter's textfile collector must never see a partially written file
+    temporary = "{}.{}.tmp".format(path, os.getpid())
+    with open(temporary, "w") as f:
+        f.write(content)
+    os.replace(temporary, path)
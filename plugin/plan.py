@@ -0,0 +1,47 @@
+import json
+import logging as l
+import time
+from typing import Dict, List, NamedTuple
+
+from metrics import write_atomically
+from repository import Repo, Branch
+
+# types
+from drone import BuildTriggers
+from repository import BranchesOfRepos
+
+# The targets found by one run, which a later run triggers without any discovery. Hook tokens are not part of the
+# plan, they are secrets and are looked up again when the plan is executed, usually in the state.
+Plan = NamedTuple("Plan", [("source", Repo), ("froms", List[str]), ("created", float),
+                           ("branches", BranchesOfRepos), ("matched", Dict[Repo, Dict[Branch, str]])])
+
+VERSION = 1
+
+
+def write_plan(path: str, source: Repo, froms: List[str], triggers: BuildTriggers) -> None:
+    # one [name, sha1, matched image] triple per branch, without any whitespace
+    repos = {repo.full_name: [[branch.name, branch.sha1, trigger.matched.get(branch.name)]
+                              for branch in trigger.branches]
+             for repo, trigger in sorted(triggers.items())}
+    doc = {"version": VERSION, "source": source.full_name, "from": froms, "created": time.time(), "repos": repos}
+    write_atomically(path, json.dumps(doc, separators=(",", ":")) + "\n")
+    l.info("Wrote plan of %s builds of %s repositories to %s.",
+           sum(len(branches) for branches in repos.values()), len(repos), path)
+
+
+def read_plan(path: str) -> Plan:
+    try:
+        with open(path) as f:
+            doc = json.load(f)
+        if doc.get("version") != VERSION:
+            raise ValueError("unsupported version {}".format(doc.get("version")))
+        branches_of_repos = {}  # type: BranchesOfRepos
+        matched = {}  # type: Dict[Repo, Dict[Branch, str]]
+        for full_name, branches in doc["repos"].items():
+            repo = Repo.from_full_name(full_name)
+            branches_of_repos[repo] = [Branch(name, sha1) for name, sha1, _ in branches]
+            matched[repo] = {Branch(name, sha1): image for name, sha1, image in branches if image}
+        return Plan(Repo.from_full_name(doc["source"]), doc["from"], doc["created"], branches_of_repos, matched)
+    except (OSError, ValueError, KeyError, TypeError) as e:
+        l.error("Unable to read the plan %s: %s", path, e)
+        raise SystemExit(1)
@@ -1,35 +1,441 @@
+import base64
+import http.client
 import json
-import urllib.request
+import random
+import re
+import threading
+import time
 import urllib.parse
-import urllib.error
-from typing import Union, Dict
+import urllib.request
+import zlib
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+from typing import Callable, Union, Dict, Iterator, List, Optional, Tuple
+
+from cache import ResponseCache
+from metrics import Metrics, endpoint_of
 
 Json = Union[list, dict]
+PoolKey = Tuple[str, str, int]
+# decides from the part of the body read so far whether the rest is still needed
+ReadEnough = Callable[[bytes], bool]
+
+LINK_PATTERN = re.compile(r'<([^>]*)>\s*((?:;\s*[^;,]*)*)')
+
+
+class ConnectionPool(object):
+    CONNECTION_CLASSES = {"http": http.client.HTTPConnection, "https": http.client.HTTPSConnection}
+
+    def __init__(self, max_size: int = 10, proxies: Dict[str, str] = None) -> None:
+        self.max_size = max_size
+        # like urlopen, http_proxy and https_proxy are honoured unless no_proxy names the host
+        self.proxies = urllib.request.getproxies() if proxies is None else proxies
+        self._idle = {}  # type: Dict[PoolKey, List[http.client.HTTPConnection]]
+        self._proxies_of_keys = {}  # type: Dict[PoolKey, Optional[urllib.parse.SplitResult]]
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def key_of(url: urllib.parse.SplitResult) -> PoolKey:
+        scheme = url.scheme.lower()
+        port = url.port or (443 if scheme == "https" else 80)
+        return scheme, url.hostname, port
+
+    def proxy_of(self, key: PoolKey) -> Optional[urllib.parse.SplitResult]:
+        with self._lock:
+            if key in self._proxies_of_keys:
+                return self._proxies_of_keys[key]
+        scheme, host, port = key
+        proxy = self.proxies.get(scheme)
+        if proxy and not urllib.request.proxy_bypass("{}:{}".format(host, port)):
+            proxy = urllib.parse.urlsplit(proxy if "://" in proxy else "http://" + proxy)
+        else:
+            proxy = None
+        with self._lock:
+            self._proxies_of_keys[key] = proxy
+        return proxy
+
+    def acquire(self, key: PoolKey) -> Tuple[http.client.HTTPConnection, bool]:
+        with self._lock:
+            idle = self._idle.get(key)
+            if idle:
+                return idle.pop(), True
+        scheme, host, port = key
+        if scheme not in self.CONNECTION_CLASSES:
+            raise UnsupportedSchemeException("Unsupported URL scheme '{}'".format(scheme))
+        proxy = self.proxy_of(key)
+        if not proxy:
+            return self.CONNECTION_CLASSES[scheme](host, port), False
+        # HTTPS is tunneled through the proxy with CONNECT, plain HTTP requests are sent to the proxy itself
+        connection = self.CONNECTION_CLASSES[scheme](proxy.hostname, proxy.port or 80)
+        if scheme == "https":
+            connection.set_tunnel(host, port, proxy_headers(proxy))
+        return connection, False
+
+    def release(self, key: PoolKey, connection: http.client.HTTPConnection) -> None:
+        with self._lock:
+            idle = self._idle.setdefault(key, [])
+            if len(idle) < self.max_size:
+                idle.append(connection)
+                return
+        connection.close()
+
+    def close(self) -> None:
+        with self._lock:
+            connections = [c for idle in self._idle.values() for c in idle]
+            self._idle.clear()
+        for connection in connections:
+            connection.close()
+
+
+def proxy_headers(proxy: urllib.parse.SplitResult) -> Dict[str, str]:
+    if not proxy.username:
+        return {}
+    credentials = "{}:{}".format(urllib.parse.unquote(proxy.username), urllib.parse.unquote(proxy.password or ""))
+    return {"Proxy-Authorization": "Basic {}".format(base64.b64encode(credentials.encode()).decode())}
+
+
+class RateLimiter(object):
+    # Token bucket whose rate adapts to the server (AIMD): the rate is halved, at most once per window, whenever the
+    # server signals overload by answering 429 or 503, failing or answering an endpoint much slower than it used to,
+    # and recovers step by step otherwise.
+    OVERLOAD_STATUSES = (429, 503)
+    SLOW_FACTOR = 3.0
+    RECOVERY_STEPS = 20
+    WINDOW = 1.0
+    # the baseline latency of an endpoint rises by this share per response, a lasting change becomes the new normal
+    BASELINE_DRIFT = 0.01
+
+    def __init__(self, rate: float) -> None:
+        self.max_rate = rate
+        self.min_rate = rate / 50
+        self.rate = rate
+        self.tokens = max(1.0, rate)
+        self.updated = time.monotonic()
+        self.decreased = None  # type: Optional[float]
+        # moving average and baseline of the latency per endpoint, listings and raw files differ by far
+        self.latencies = {}  # type: Dict[str, Tuple[float, float]]
+        self._lock = threading.Lock()
+
+    def acquire(self) -> None:
+        while True:
+            with self._lock:
+                now = time.monotonic()
+                self.tokens = min(max(1.0, self.rate), self.tokens + (now - self.updated) * self.rate)
+                self.updated = now
+                if self.tokens >= 1:
+                    self.tokens -= 1
+                    return
+                delay = (1 - self.tokens) / self.rate
+            time.sleep(delay)
+
+    def observe(self, status: Optional[int], seconds: float, endpoint: str = "") -> None:
+        with self._lock:
+            overloaded = status is None or status in self.OVERLOAD_STATUSES
+            if not overloaded:
+                # exponentially weighted moving average of the latency, compared to the slowly rising lowest average
+                latency, baseline = self.latencies.get(endpoint, (seconds, seconds))
+                latency = 0.9 * latency + 0.1 * seconds
+                baseline = min(latency, baseline * (1 + self.BASELINE_DRIFT))
+                self.latencies[endpoint] = (latency, baseline)
+                overloaded = latency > self.SLOW_FACTOR * max(baseline, 0.001)
+            now = time.monotonic()
+            if not overloaded:
+                self.rate = min(self.max_rate, self.rate + self.max_rate / self.RECOVERY_STEPS)
+            elif self.decreased is None or now - self.decreased >= self.WINDOW:
+                self.rate = max(self.min_rate, self.rate / 2)
+                self.decreased = now
+
+
+class Decompressor(object):
+    # Streaming decoder of a gzip or deflate encoded body. Every call returns at most max_length bytes and keeps the
+    # rest of the input in unconsumed_tail, so that a small compressed body cannot expand beyond the size limit.
+    def __init__(self, encoding: str) -> None:
+        self.encoding = encoding
+        self._decoder = zlib.decompressobj(16 + zlib.MAX_WBITS if encoding == "gzip" else zlib.MAX_WBITS)
+        self._first = True
+
+    @property
+    def unconsumed_tail(self) -> bytes:
+        return self._decoder.unconsumed_tail
+
+    def decompress(self, data: bytes, max_length: int) -> bytes:
+        if self._first and self.encoding == "deflate":
+            # "deflate" is meant to be zlib wrapped, but some servers send a raw deflate stream
+            self._first = False
+            try:
+                return self._decoder.decompress(data, max_length)
+            except zlib.error:
+                self._decoder = zlib.decompressobj(-zlib.MAX_WBITS)
+        return self._decoder.decompress(data, max_length)
+
+    def flush(self) -> bytes:
+        return self._decoder.flush()
+
+
+class Response(object):
+    def __init__(self, url: str, status: int, reason: str, headers: http.client.HTTPMessage, body: bytes,
+                 size: int = None, truncated: bool = False) -> None:
+        self.url = url
+        self.status = status
+        self.reason = reason
+        self.headers = headers
+        self.body = body
+        # bytes received, which differ from the body if it was compressed or cached
+        self.size = len(body) if size is None else size
+        # the body ends early, because the rest was not needed
+        self.truncated = truncated
+
+    def text(self) -> str:
+        return self.body.decode(self.headers.get_content_charset() or "utf-8")
+
+    def link(self, rel: str) -> Optional[str]:
+        # RFC 5988 Link header, e.g. '<https://git.example.com/api/v1/user/repos?page=2>; rel="next"'
+        for target, params in LINK_PATTERN.findall(self.headers.get("Link") or ""):
+            rels = re.search(r';\s*rel="?([^";]*)"?', params)
+            if rels and rel in rels.group(1).split():
+                return urllib.parse.urljoin(self.url, target)
+        return None
 
 
 class Requester(object):
+    MAX_REDIRECTS = 5
+    # retries wait a random time up to BACKOFF_BASE * 2 ** attempt seconds, but at most BACKOFF_CAP seconds
+    BACKOFF_BASE = 0.5
+    BACKOFF_CAP = 10.0
+    # errors which indicate that the server closed an idle keep-alive connection before we reused it
+    STALE_CONNECTION_ERRORS = (http.client.RemoteDisconnected, ConnectionResetError, BrokenPipeError)
+    ACCEPT_ENCODING = "gzip, deflate"
+    CHUNK_SIZE = 64 * 1024
+    # larger bodies are not worth keeping to revalidate them
+    MAX_CACHED_SIZE = 1024 * 1024
+
+    def __init__(self, pool: ConnectionPool = None, timeout: float = None, retries: int = 0, deadline: float = None,
+                 hedge_after: float = None, rate_limit: float = None, max_body_size: int = 16 * 1024 * 1024,
+                 responses: ResponseCache = None) -> None:
+        self.pool = pool or ConnectionPool()
+        self.timeout = timeout
+        self.retries = retries
+        # time.monotonic() after which no request is started anymore and running ones time out
+        self.deadline = deadline
+        self.hedge_after = hedge_after
+        self._hedges = ThreadPoolExecutor(max_workers=2 * self.pool.max_size) if hedge_after else None
+        # requests per second and host, every host gets its own limiter
+        self.rate_limit = rate_limit
+        self._limiters = {}  # type: Dict[PoolKey, RateLimiter]
+        self._limiters_lock = threading.Lock()
+        self.max_body_size = max_body_size
+        # bodies of earlier GETs with an ETag, which are revalidated with If-None-Match instead of sent again
+        self.responses = responses
+
+    def close(self) -> None:
+        if self._hedges:
+            self._hedges.shutdown(wait=False)
+        self.pool.close()
+
     def request_json(self, url: str, headers: Dict[str, str] = None, data: bytes = None) -> Json:
         headers = headers or {}
         content = self.request(url, headers, data, "application/json")
         doc = json.loads(content)
         return doc
 
-    @staticmethod
-    def request(url: str, headers: Dict[str, str] = None, data: bytes = None, expected_content_type: str = None) -> str:
+    def request(self, url: str, headers: Dict[str, str] = None, data: bytes = None,
+                expected_content_type: str = None, enough: ReadEnough = None) -> str:
+        return self.request_response(url, headers, data, expected_content_type, enough).text()
+
+    def request_response(self, url: str, headers: Dict[str, str] = None, data: bytes = None,
+                         expected_content_type: str = None, enough: ReadEnough = None,
+                         revalidate: bool = False) -> Response:
         headers = headers or {}
         method = "POST" if data else "GET"
-        req = urllib.request.Request(url, headers=headers, method=method, data=data)
         try:
-            with urllib.request.urlopen(req) as res:
-                if res.getcode == 204:
-                    raise NoContentException(204, res.geturl())
-                if expected_content_type:
-                    if res.headers.get_content_type() != expected_content_type:
-                        raise WrongContentTypeException(res.headers.get_content_type())
-                return res.read().decode(res.headers.get_content_charset())
-        except (urllib.error.HTTPError, NoContentException, WrongContentTypeException) as e:
+            res = self.send_conditionally(method, url, headers, data, enough, revalidate)
+            if res.status == 204:
+                raise NoContentException(204, res.url)
+            if expected_content_type:
+                if res.headers.get_content_type() != expected_content_type:
+                    raise WrongContentTypeException(res.headers.get_content_type())
+            return res
+        except (HTTPStatusException, NoContentException, WrongContentTypeException, UnsupportedSchemeException,
+                TooManyRedirectsException, DeadlineExceededException, ResponseTooLargeException,
+                http.client.HTTPException, OSError, zlib.error) as e:
             raise RequesterException("Error during request to {}".format(url)) from e
 
+    def send_conditionally(self, method: str, url: str, headers: Dict[str, str], data: bytes = None,
+                           enough: ReadEnough = None, revalidate: bool = False) -> Response:
+        # a body which did not change since it was cached is answered with 304 and not sent again, only listings
+        # are worth it, responses for a commit never change and are covered by the Dockerfile cache and the state
+        cacheable = bool(self.responses) and revalidate and method == "GET"
+        cached = self.responses.get(url) if cacheable else None
+        if cached:
+            headers = dict(headers, **{"If-None-Match": cached.etag})
+        res = self.send_with_retries(method, url, headers, data, enough)
+        if cached and res.status == 304:
+            return Response(url, res.status, res.reason, headers_of(cached.headers), cached.body, res.size)
+        etag = res.headers.get("ETag")
+        if cacheable and res.status == 200 and etag and not res.truncated and \
+                len(res.body) <= self.MAX_CACHED_SIZE:
+            self.responses.put(url, etag, [(key, value) for key, value in res.headers.items()
+                                           if key.lower() not in ("content-encoding", "content-length")], res.body)
+        return res
+
+    def send_with_retries(self, method: str, url: str, headers: Dict[str, str], data: bytes = None,
+                          enough: ReadEnough = None) -> Response:
+        # only GETs are repeated, a repeated POST could trigger a build twice
+        attempt = 0
+        while True:
+            try:
+                if method == "GET":
+                    return self.send_hedged(method, url, headers, enough)
+                return self.send(method, url, headers, data)
+            except (HTTPStatusException, http.client.HTTPException, OSError) as e:
+                if method != "GET" or attempt >= self.retries or not self.is_transient(e):
+                    raise
+                delay = random.uniform(0, min(self.BACKOFF_CAP, self.BACKOFF_BASE * 2 ** attempt))
+                if self.deadline is not None and time.monotonic() + delay >= self.deadline:
+                    raise
+            time.sleep(delay)
+            attempt += 1
+
+    @staticmethod
+    def is_transient(e: Exception) -> bool:
+        return e.getcode() >= 500 or e.getcode() == 429 if isinstance(e, HTTPStatusException) else True
+
+    def send_hedged(self, method: str, url: str, headers: Dict[str, str], enough: ReadEnough = None) -> Response:
+        # a duplicate of a request which is slower than usual often answers first, which cuts off the latency tail
+        if not self._hedges:
+            return self.send(method, url, headers, enough=enough)
+        first = self._hedges.submit(self.send, method, url, headers, None, enough)
+        done, pending = wait([first], timeout=self.hedge_after)
+        if not done:
+            pending = {first, self._hedges.submit(self.send, method, url, headers, None, enough)}
+        while True:
+            successful = [future for future in done if not future.exception()]
+            if successful or not pending:
+                return (successful or list(done))[0].result()
+            done, pending = wait(pending, return_when=FIRST_COMPLETED)
+
+    def limiter_of(self, key: PoolKey) -> Optional[RateLimiter]:
+        if not self.rate_limit:
+            return None
+        with self._limiters_lock:
+            if key not in self._limiters:
+                self._limiters[key] = RateLimiter(self.rate_limit)
+            return self._limiters[key]
+
+    def expired(self) -> bool:
+        return self.deadline is not None and time.monotonic() >= self.deadline
+
+    def timeout_of_attempt(self) -> Optional[float]:
+        if self.deadline is None:
+            return self.timeout
+        remaining = self.deadline - time.monotonic()
+        if remaining <= 0:
+            raise DeadlineExceededException("Exceeded the deadline of the run")
+        return remaining if self.timeout is None else min(self.timeout, remaining)
+
+    def send(self, method: str, url: str, headers: Dict[str, str], data: bytes = None,
+             enough: ReadEnough = None) -> Response:
+        for _ in range(self.MAX_REDIRECTS + 1):
+            res = self.send_once(method, url, headers, data, enough)
+            location = res.headers.get("Location")
+            if res.status in (301, 302, 303, 307, 308) and location:
+                url = urllib.parse.urljoin(url, location)
+                if res.status == 303 or (res.status in (301, 302) and method == "POST"):
+                    method, data = "GET", None
+                continue
+            if res.status >= 400:
+                raise HTTPStatusException(res.status, res.url, res.reason)
+            return res
+        raise TooManyRedirectsException("Exceeded {} redirects".format(self.MAX_REDIRECTS))
+
+    def send_once(self, method: str, url: str, headers: Dict[str, str], data: bytes = None,
+                  enough: ReadEnough = None) -> Response:
+        key = ConnectionPool.key_of(urllib.parse.urlsplit(url))
+        limiter = self.limiter_of(key)
+        if not limiter:
+            return self.send_on_connection(key, method, url, headers, data, enough)
+        limiter.acquire()
+        started, status = time.monotonic(), None
+        try:
+            res = self.send_on_connection(key, method, url, headers, data, enough)
+            status = res.status
+            return res
+        finally:
+            limiter.observe(status, time.monotonic() - started, endpoint_of(urllib.parse.urlsplit(url).path))
+
+    def send_on_connection(self, key: PoolKey, method: str, url: str, headers: Dict[str, str],
+                           data: bytes = None, enough: ReadEnough = None) -> Response:
+        split = urllib.parse.urlsplit(url)
+        target = urllib.parse.urlunsplit(("", "", split.path or "/", split.query, ""))
+        if not any(name.lower() == "accept-encoding" for name in headers):
+            headers = dict(headers, **{"Accept-Encoding": self.ACCEPT_ENCODING})
+        proxy = self.pool.proxy_of(key)
+        if proxy and key[0] == "http":
+            # a proxy forwarding plain HTTP expects the absolute URL
+            target = urllib.parse.urlunsplit(split[:4] + ("",))
+            headers = dict(headers, **proxy_headers(proxy))
+        while True:
+            timeout = self.timeout_of_attempt()
+            connection, reused = self.pool.acquire(key)
+            connection.timeout = timeout
+            if connection.sock:
+                connection.sock.settimeout(timeout)
+            sent = False
+            try:
+                connection.request(method, target, body=data, headers=headers)
+                sent = True
+                res = connection.getresponse()
+                body, size, truncated = self.read_body(res, enough)
+            except self.STALE_CONNECTION_ERRORS:
+                connection.close()
+                # a POST which was sent completely may have been received before the connection broke,
+                # repeating it could trigger a build twice
+                if reused and (method != "POST" or not sent):
+                    continue
+                raise
+            except BaseException:
+                connection.close()
+                raise
+            if res.will_close or truncated:
+                # the rest of a truncated body is still on its way, the connection cannot be reused
+                connection.close()
+            else:
+                self.pool.release(key, connection)
+            return Response(url, res.status, res.reason, res.headers, body, size, truncated)
+
+    def read_body(self, res: http.client.HTTPResponse, enough: ReadEnough = None) -> Tuple[bytes, int, bool]:
+        # the decoded body, the number of bytes received and whether reading stopped because enough was read
+        encoding = (res.headers.get("Content-Encoding") or "").strip().lower()
+        decompressor = Decompressor(encoding) if encoding in ("gzip", "deflate") else None
+        body = bytearray()
+        size = 0
+        while True:
+            chunk = res.read(self.CHUNK_SIZE)
+            if not chunk:
+                break
+            size += len(chunk)
+            while chunk:
+                if decompressor:
+                    body += decompressor.decompress(chunk, self.CHUNK_SIZE)
+                    chunk = decompressor.unconsumed_tail
+                else:
+                    body += chunk
+                    chunk = b""
+                if len(body) > self.max_body_size:
+                    raise ResponseTooLargeException("Response exceeds {} bytes".format(self.max_body_size))
+                if enough and res.status < 300 and enough(body):
+                    # only complete lines, a line cut in the middle could end in the middle of a character as well
+                    return bytes(body[:body.rfind(b"\n") + 1]), size, True
+        if decompressor:
+            body += decompressor.flush()
+        return bytes(body), size, False
+
+
+def headers_of(items: List[Tuple[str, str]]) -> http.client.HTTPMessage:
+    headers = http.client.HTTPMessage()
+    for key, value in items:
+        headers[key] = value
+    return headers
+
 
 class ExceptionWithReason(Exception):
     def __init__(self, message: str = None) -> None:
@@ -72,31 +478,98 @@ class NoContentException(ExceptionWithReason):
         return self.url
 
 
+class HTTPStatusException(ExceptionWithReason):
+    def __init__(self, code: int, url: str, reason: str = "") -> None:
+        super().__init__("HTTP Error {}: {}".format(code, reason))
+        self.code = code
+        self.url = url
+
+    def getcode(self) -> int:
+        return self.code
+
+    def geturl(self) -> str:
+        return self.url
+
+
+class TooManyRedirectsException(ExceptionWithReason):
+    pass
+
+
+class DeadlineExceededException(ExceptionWithReason):
+    pass
+
+
+class ResponseTooLargeException(ExceptionWithReason):
+    pass
+
+
+class UnsupportedSchemeException(ExceptionWithReason):
+    pass
+
+
 class WrongContentTypeException(ExceptionWithReason):
     def __init__(self, content_type: str) -> None:
         super().__init__("Received unexpected content type '{}'".format(content_type))
 
 
 class Client(object):
-    def __init__(self, requester: Requester, api_url: str, headers: Dict[str, str] = None) -> None:
+    NAME = "api"
+
+    def __init__(self, requester: Requester, api_url: str, headers: Dict[str, str] = None,
+                 metrics: Metrics = None) -> None:
         self.requester = requester
         self.api_url = api_url
         self.headers = headers or {}
+        self.metrics = metrics
 
     def add_header(self, key: str, value: str) -> None:
         self.headers[key] = value
 
-    def request_raw(self, path: str, data: bytes = None) -> str:
-        try:
-            return self.requester.request(self.api_url + path, self.headers, data)
-        except RequesterException as e:
-            raise ClientException("Client error") from e
+    def merge_headers(self, headers: Dict[str, str] = None) -> Dict[str, str]:
+        return dict(self.headers, **headers) if headers else self.headers
 
-    def request_json(self, path: str, data: bytes = None) -> Json:
+    def request_response(self, path: str, data: bytes = None, headers: Dict[str, str] = None,
+                         expected_content_type: str = None, enough: ReadEnough = None,
+                         revalidate: bool = False) -> Response:
+        started = time.perf_counter()
+        status, size = None, 0
         try:
-            return self.requester.request_json(self.api_url + path, self.headers, data)
+            res = self.requester.request_response(self.api_url + path, self.merge_headers(headers), data,
+                                                  expected_content_type, enough, revalidate)
+            status, size = res.status, res.size
+            return res
         except RequesterException as e:
+            status = e.getcode()
             raise ClientException("Client error") from e
+        finally:
+            if self.metrics:
+                self.metrics.observe_request(self.NAME, "POST" if data else "GET", path, status,
+                                             time.perf_counter() - started, size)
+
+    def request_raw(self, path: str, data: bytes = None, headers: Dict[str, str] = None,
+                    enough: ReadEnough = None) -> str:
+        return self.request_response(path, data, headers, enough=enough).text()
+
+    def request_json(self, path: str, data: bytes = None, headers: Dict[str, str] = None) -> Json:
+        return json.loads(self.request_response(path, data, headers, "application/json").text())
+
+    def request_pages(self, path: str) -> Iterator[Json]:
+        # yields one page after the other, paginated endpoints point to the next page in their Link header
+        while path:
+            res = self.request_response(path, expected_content_type="application/json", revalidate=True)
+            yield json.loads(res.text())
+            path = self.path_of(res.link("next"))
+
+    def path_of(self, url: Optional[str]) -> Optional[str]:
+        # servers behind a reverse proxy often link to their own root URL, so only the path has to be below the API,
+        # the request still goes to the configured host
+        if not url:
+            return None
+        link = urllib.parse.urlsplit(url)
+        api_path = urllib.parse.urlsplit(self.api_url).path.rstrip("/")
+        if link.path != api_path and not link.path.startswith(api_path + "/"):
+            raise ClientException("Refusing to follow link to {} outside of {}".format(url, self.api_url))
+        return link.path[len(api_path):] + ("?" + link.query if link.query else "")
 
 
 class ClientException(ExceptionWithReason):
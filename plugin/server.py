@@ -0,0 +1,247 @@
+#!/usr/bin/env python3
+
+import hashlib
+import hmac
+import json
+import logging as l
+import threading
+import time
+from http.server import HTTPServer, BaseHTTPRequestHandler
+from socketserver import ThreadingMixIn
+from typing import Dict, List, Tuple
+
+import configuration
+from dockerfile import matching_from
+from repository import Repo, Branch
+from trigger import TriggerPlugin, create_plugin, list_images, list_repos_with_branches
+
+# types
+from cascade import ImagesOfBranches
+
+
+class DownstreamIndex(object):
+    # the FROM images of the heads of all branches, kept in memory between requests
+    def __init__(self) -> None:
+        self._images = {}  # type: Dict[Repo, Dict[str, Tuple[Branch, List[str]]]]
+        self._lock = threading.Lock()
+
+    def replace(self, images_of_branches: ImagesOfBranches) -> None:
+        images = {repo: {branch.name: (branch, images) for branch, images in branches}
+                  for repo, branches in images_of_branches.items()}
+        with self._lock:
+            self._images = images
+
+    def knows(self, repo: Repo) -> bool:
+        with self._lock:
+            return repo in self._images
+
+    def update(self, repo: Repo, branch: Branch, images: List[str]) -> None:
+        with self._lock:
+            self._images.setdefault(repo, {})[branch.name] = (branch, images)
+
+    def remove(self, repo: Repo, branch_name: str) -> None:
+        with self._lock:
+            self._images.get(repo, {}).pop(branch_name, None)
+
+    def lookup(self, froms: List[str]) -> Dict[Repo, Dict[Branch, str]]:
+        # the downstream branches and the wanted image each of them matched
+        with self._lock:
+            snapshot = [(repo, list(branches.values())) for repo, branches in self._images.items()]
+        downstream = {}
+        for repo, branches in snapshot:
+            matched = {branch: matching_from(images, froms) for branch, images in branches}
+            matched = {branch: image for branch, image in matched.items() if image}
+            if matched:
+                downstream[repo] = matched
+        return downstream
+
+    def size(self) -> Tuple[int, int]:
+        with self._lock:
+            return len(self._images), sum(len(branches) for branches in self._images.values())
+
+
+class DownstreamService(object):
+    NULL_SHA1 = "0" * 40
+    # the caches are evicted after every refresh, and at least this often while pushes and triggers keep coming
+    EVICTION_INTERVAL = 60 * 60
+
+    def __init__(self, plugin: TriggerPlugin) -> None:
+        self.plugin = plugin
+        self.index = DownstreamIndex()
+        self._refresh_lock = threading.Lock()
+        self._evicted = time.monotonic()
+        self._eviction_lock = threading.Lock()
+
+    def refresh(self) -> None:
+        with self._refresh_lock:
+            l.info("Crawling repositories.")
+            try:
+                repos = self.plugin.drone.retrieve_repos(self.plugin.targets)
+            except SystemExit:
+                l.error("Keeping the previous index, the repositories could not be crawled.")
+                return
+            branches_of_repos = self.plugin.get_branches_of_repos(repos)
+            self.index.replace(self.plugin.get_images_of_branches(branches_of_repos))
+            l.info("Indexed %s branches of %s repositories.", self.index.size()[1], self.index.size()[0])
+        self.evict(force=True)
+
+    def evict(self, force: bool = False) -> None:
+        with self._eviction_lock:
+            if not force and time.monotonic() < self._evicted + DownstreamService.EVICTION_INTERVAL:
+                return
+            self._evicted = time.monotonic()
+        self.plugin.evict()
+
+    def push(self, repo: Repo, ref: str, after: str) -> None:
+        if not ref.startswith("refs/heads/"):
+            l.debug("Ignoring push of %s to %s, it is not a branch.", repo.full_name, ref)
+            return
+        if not self.index.knows(repo):
+            l.debug("Ignoring push of %s, it is not an active Drone repository.", repo.full_name)
+            return
+        branch_name = ref[len("refs/heads/"):]
+        if not self.plugin.targets.accepts_branch(branch_name):
+            l.debug("Ignoring push of %s to %s, the branch is filtered out.", repo.full_name, branch_name)
+            return
+        if after == DownstreamService.NULL_SHA1:
+            self.remove_branch(repo, branch_name)
+            return
+        branch = Branch(branch_name, after)
+        images = self.plugin.searcher.find_from_images_of_commit(repo, [branch])
+        self.index.update(repo, branch, images)
+        l.info("Updated %s on branch %s to %s: %s", repo.full_name, branch_name, after, ", ".join(images) or "-")
+        self.evict()
+
+    def delete(self, repo: Repo, ref: str, ref_type: str) -> None:
+        # Gogs reports deleted branches as delete events with the bare branch name, not as pushes
+        if ref_type != "branch":
+            l.debug("Ignoring deletion of %s %s of %s.", ref_type, ref, repo.full_name)
+            return
+        self.remove_branch(repo, ref)
+
+    def remove_branch(self, repo: Repo, branch_name: str) -> None:
+        l.info("Removing branch %s of %s from the index.", branch_name, repo.full_name)
+        self.index.remove(repo, branch_name)
+        if self.plugin.state:
+            self.plugin.state.drop_branch(repo, branch_name)
+
+    def trigger(self, froms: List[str], source: Repo, dry_run: bool) -> dict:
+        downstream = self.index.lookup(froms)
+        build_triggers = self.plugin.create_build_triggers(
+            {repo: list(matched) for repo, matched in downstream.items()}, downstream)
+        l.info("Triggering builds of downstream repositories of %s for %s.", list_images(froms), source.full_name)
+        self.plugin.log_builds_to_trigger(build_triggers)
+        builds_triggered = 0 if dry_run else self.plugin.drone.trigger_builds(
+            build_triggers, source, refresh_token=self.plugin.refresh_drone_token)
+        self.evict()
+        return {"targets": list_repos_with_branches(build_triggers), "triggered": builds_triggered}
+
+
+class ServiceHandler(BaseHTTPRequestHandler):
+    def log_message(self, format, *args) -> None:
+        l.debug("%s " + format, self.address_string(), *args)
+
+    def reply(self, code: int, doc: dict) -> None:
+        content = json.dumps(doc).encode()
+        self.send_response(code)
+        self.send_header("Content-Type", "application/json; charset=utf-8")
+        self.send_header("Content-Length", str(len(content)))
+        self.end_headers()
+        self.wfile.write(content)
+
+    def read_body(self) -> bytes:
+        length = int(self.headers.get("Content-Length") or 0)
+        return self.rfile.read(length) if length else b""
+
+    def do_GET(self) -> None:
+        if self.path != "/health":
+            return self.reply(404, {"error": "Not found"})
+        repos, branches = self.server.service.index.size()
+        self.reply(200, {"repos": repos, "branches": branches})
+
+    def do_POST(self) -> None:
+        body = self.read_body()
+        try:
+            if self.path == "/hooks/gogs":
+                self.handle_gogs_hook(body)
+            elif self.path == "/trigger":
+                self.handle_trigger(body)
+            else:
+                self.reply(404, {"error": "Not found"})
+        except (ValueError, KeyError, TypeError) as e:
+            self.reply(400, {"error": "Malformed request: {}".format(e)})
+
+    def handle_gogs_hook(self, body: bytes) -> None:
+        secret = self.server.config.server_secret
+        if secret:
+            signature = hmac.new(secret.encode(), body, hashlib.sha256).hexdigest()
+            if not hmac.compare_digest(signature, self.headers.get("X-Gogs-Signature") or ""):
+                return self.reply(403, {"error": "Invalid signature"})
+        event = self.headers.get("X-Gogs-Event", "push")
+        if event not in ("push", "delete"):
+            return self.reply(202, {"status": "ignored"})
+        doc = json.loads(body.decode())
+        repo = Repo(doc["repository"]["owner"]["username"], doc["repository"]["name"])
+        if event == "push":
+            self.server.service.push(repo, doc["ref"], doc["after"])
+        else:
+            self.server.service.delete(repo, doc["ref"], doc["ref_type"])
+        self.reply(202, {"status": "accepted"})
+
+    def handle_trigger(self, body: bytes) -> None:
+        token = self.server.config.server_token
+        if token and not hmac.compare_digest(self.headers.get("Authorization") or "", "Bearer " + token):
+            return self.reply(401, {"error": "Invalid token"})
+        doc = json.loads(body.decode())
+        # older clients send a single image
+        froms = doc["from"] if isinstance(doc["from"], list) else [doc["from"]]
+        result = self.server.service.trigger(froms, Repo.from_full_name(doc["source"]),
+                                             bool(doc.get("dry_run")))
+        self.reply(200, result)
+
+
+class ServiceServer(ThreadingMixIn, HTTPServer):
+    daemon_threads = True
+
+    def __init__(self, config: configuration.Config, service: DownstreamService) -> None:
+        super().__init__(("", config.server_port), ServiceHandler)
+        self.config = config
+        self.service = service
+
+
+def refresh_periodically(service: DownstreamService, interval: int, stop: threading.Event) -> None:
+    while not stop.wait(interval):
+        service.refresh()
+
+
+def main() -> None:
+    l.basicConfig(format='%(asctime)s %(levelname)-8s %(message)s', datefmt='%H:%M:%S', level=l.INFO)
+    config = configuration.Config.create_from_env()
+    configuration.validate_service(config)
+    if config.verbose:
+        l.getLogger().setLevel(l.DEBUG)
+        l.debug("Enabled verbose logging.")
+
+    # the service runs indefinitely, a deadline only makes sense for a single run
+    plugin, close = create_plugin(config._replace(run_deadline=0))
+    service = DownstreamService(plugin)
+    service.refresh()
+    stop = threading.Event()
+    if config.server_refresh_interval:
+        threading.Thread(target=refresh_periodically, args=(service, config.server_refresh_interval, stop),
+                         daemon=True).start()
+
+    server = ServiceServer(config, service)
+    l.info("Listening on port %s.", server.server_address[1])
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        stop.set()
+        server.server_close()
+        close()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,347 @@
+#!/usr/bin/env python3
+
+import gzip
+import hashlib
+import json
+import logging as l
+import multiprocessing
+import random
+import re
+import threading
+import time
+import urllib.parse
+import urllib.request
+from collections import Counter
+from http.server import HTTPServer, BaseHTTPRequestHandler
+from socketserver import ThreadingMixIn
+from typing import NamedTuple, Dict, List, Tuple, Optional
+
+from repository import Repo, Branch
+
+# Local stand-in for the Gogs and Drone APIs used by the plugin, serving a generated set of repositories.
+# It backs the benchmark and allows trying out the plugin and the downstream service without real servers.
+
+Scenario = NamedTuple("Scenario", [("repos", int), ("branches", int), ("dockerfile_ratio", float),
+                                   ("latency", float), ("error_rate", float), ("from_", str), ("seed", int),
+                                   ("build_time", float)])
+
+
+def scenario(repos: int = 100, branches: int = 4, dockerfile_ratio: float = 0.5, latency: float = 0.0,
+             error_rate: float = 0.0, from_: str = "base:alpine", seed: int = 0, build_time: float = 0.0) -> Scenario:
+    return Scenario(repos, branches, dockerfile_ratio, latency, error_rate, from_, seed, build_time)
+
+
+PAGE_SIZE = 50
+COMPRESS_MIN_SIZE = 1024
+TREE_PAGE_SIZE = 1000
+
+ENDPOINTS = [
+    ("drone /user/repos", re.compile(r"^/drone/user/repos$")),
+    ("drone /hook", re.compile(r"^/drone/hook$")),
+    ("drone /repos/{repo}/builds/{number}", re.compile(r"^/drone/repos/([^/]+)/([^/]+)/builds/(\d+)$")),
+    ("gogs /repos/{repo}/branches", re.compile(r"^/gogs/repos/([^/]+)/([^/]+)/branches$")),
+    ("gogs /repos/{repo}/raw/{ref}/{path}", re.compile(r"^/gogs/repos/([^/]+)/([^/]+)/raw/([^/]+)/(.+)$")),
+    ("gogs /repos/{repo}/git/trees/{sha}", re.compile(r"^/gogs/repos/([^/]+)/([^/]+)/git/trees/([^/]+)$")),
+    ("gogs /repos/{repo}/hooks", re.compile(r"^/gogs/repos/([^/]+)/([^/]+)/hooks$")),
+]
+
+
+class StubData(object):
+    def __init__(self, scenario: Scenario) -> None:
+        self.scenario = scenario
+        self.repos = [Repo("owner{}".format(i % 10), "repo{}".format(i)) for i in range(scenario.repos)]
+        self.index_of = {repo: i for i, repo in enumerate(self.repos)}
+        self.heads = {repo: self.generate_branches(i) for i, repo in enumerate(self.repos)}
+        self.dockerfiles = {}  # type: Dict[Tuple[Repo, str], Optional[str]]
+        for i, repo in enumerate(self.repos):
+            for branch in self.heads[repo]:
+                self.dockerfiles[(repo, branch.sha1)] = self.generate_dockerfile(i)
+        self.builds = 0
+        self.started = {}  # type: Dict[int, Tuple[Repo, float]]
+        self.peak_running = 0
+        self.lock = threading.Lock()
+
+    def generate_branches(self, i: int) -> List[Branch]:
+        master = sha1_of("{}/master".format(i))
+        branches = [Branch("master", master)]
+        for j in range(1, self.scenario.branches):
+            # every other branch points to the same commit as master
+            branches.append(Branch("branch{}".format(j), master if j % 2 else sha1_of("{}/{}".format(i, j))))
+        return branches
+
+    def generate_dockerfile(self, i: int) -> Optional[str]:
+        hits = int(self.scenario.dockerfile_ratio * 1000)
+        if (i * 7919) % 1000 >= hits:
+            return None
+        image = self.scenario.from_ if i % 2 == 0 else "other:{}".format(i % 5)
+        return "ARG VERSION=1\nFROM {} AS build\nRUN make\nFROM build\nCMD [\"run\"]\n".format(image)
+
+    def running(self) -> List[Tuple[int, Repo]]:
+        # builds take build_time seconds and run in parallel, there are as many agents as builds
+        now = time.time()
+        return [(number, repo) for number, (repo, started) in self.started.items()
+                if now < started + self.scenario.build_time]
+
+    def token_of(self, repo: Repo) -> str:
+        return "token-{}".format(self.index_of[repo])
+
+    def push(self, repo: Repo, branch_name: str, dockerfile: Optional[str] = None) -> dict:
+        # moves the head of a branch and returns the payload of the push webhook Gogs would send
+        with self.lock:
+            branches = self.heads[repo]
+            before = next((b.sha1 for b in branches if b.name == branch_name), "0" * 40)
+            after = sha1_of("{}/{}/{}".format(repo.full_name, branch_name, time.time()))
+            self.heads[repo] = [b for b in branches if b.name != branch_name] + [Branch(branch_name, after)]
+            self.dockerfiles[(repo, after)] = dockerfile
+        return {"ref": "refs/heads/{}".format(branch_name), "before": before, "after": after,
+                "repository": {"name": repo.name, "full_name": repo.full_name,
+                               "owner": {"username": repo.owner}}}
+
+    def delete(self, repo: Repo, branch_name: str) -> dict:
+        # removes a branch and returns the payload of the delete webhook Gogs would send
+        with self.lock:
+            self.heads[repo] = [b for b in self.heads[repo] if b.name != branch_name]
+        return {"ref": branch_name, "ref_type": "branch", "pusher_type": "user",
+                "repository": {"name": repo.name, "full_name": repo.full_name,
+                               "owner": {"username": repo.owner}}}
+
+
+def sha1_of(value: str) -> str:
+    return hashlib.sha1(value.encode()).hexdigest()
+
+
+class StubHandler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+
+    def log_message(self, format, *args) -> None:
+        l.debug("stub: " + format, *args)
+
+    def reply(self, code: int, body, content_type: str = "application/json", headers: Dict[str, str] = None) -> None:
+        content = (json.dumps(body) if content_type == "application/json" else body or "").encode()
+        headers = dict(headers or {})
+        if self.command == "GET" and code == 200:
+            # like a server which answers conditional GETs and compresses larger bodies
+            headers["ETag"] = '"{}"'.format(hashlib.sha1(content).hexdigest())
+            if self.headers.get("If-None-Match") == headers["ETag"]:
+                code, content = 304, b""
+            elif len(content) >= COMPRESS_MIN_SIZE and "gzip" in (self.headers.get("Accept-Encoding") or ""):
+                headers["Content-Encoding"] = "gzip"
+                content = gzip.compress(content)
+        self.server.stats.record(self.endpoint, code, len(content))
+        self.write(code, content, content_type, headers)
+
+    def write(self, code: int, content: bytes, content_type: str, headers: Dict[str, str] = None) -> None:
+        # headers and body in one write, a separate small write would be delayed by Nagle's algorithm
+        self.send_response(code)
+        self.send_header("Content-Type", "{}; charset=utf-8".format(content_type))
+        self.send_header("Content-Length", str(len(content)))
+        for key, value in (headers or {}).items():
+            self.send_header(key, value)
+        self._headers_buffer.append(b"\r\n" + content)
+        self.flush_headers()
+
+    def dispatch(self, method: str) -> None:
+        path = urllib.parse.urlsplit(self.path).path
+        self.endpoint, match = next(((name, pattern.match(path)) for name, pattern in ENDPOINTS
+                                     if pattern.match(path)), (method + " " + path, None))
+        length = int(self.headers.get("Content-Length") or 0)
+        body = self.rfile.read(length) if length else b""
+
+        server = self.server
+        if server.scenario.latency:
+            time.sleep(server.scenario.latency)
+        if not match:
+            return self.reply(404, {"message": "Not Found"})
+        if server.scenario.error_rate and server.random.random() < server.scenario.error_rate:
+            return self.reply(503, {"message": "Injected error"})
+        handler = getattr(self, "handle_" + re.sub(r"\W+", "_", self.endpoint.split(" ", 1)[1]).strip("_"))
+        handler(method, match, body)
+
+    def do_GET(self) -> None:
+        if self.path == "/_stats":
+            return self.reply_stats()
+        self.dispatch("GET")
+
+    def reply_stats(self) -> None:
+        stats = self.server.stats
+        with stats.lock:
+            doc = {"requests": dict(stats.requests), "statuses": {str(k): v for k, v in stats.statuses.items()},
+                   "bytes": stats.bytes, "builds": self.server.data.builds,
+                   "peak_running_builds": self.server.data.peak_running}
+        self.write(200, json.dumps(doc).encode(), "application/json")
+
+    def do_POST(self) -> None:
+        self.dispatch("POST")
+
+    def repo_of(self, match) -> Repo:
+        return Repo(match.group(1), match.group(2))
+
+    def handle_user_repos(self, method: str, match, body: bytes) -> None:
+        # paginated like Gitea, the last page has no link to a next one
+        query = urllib.parse.parse_qs(urllib.parse.urlsplit(self.path).query)
+        page = int(query.get("page", ["1"])[0])
+        repos = self.server.data.repos[(page - 1) * PAGE_SIZE:page * PAGE_SIZE]
+        headers = {}
+        if page * PAGE_SIZE < len(self.server.data.repos):
+            headers["Link"] = '</drone/user/repos?page={}>; rel="next"'.format(page + 1)
+        self.reply(200, [{"owner": repo.owner, "name": repo.name, "active": True} for repo in repos], headers=headers)
+
+    def handle_hook(self, method: str, match, body: bytes) -> None:
+        doc = json.loads(body.decode())
+        repo = Repo(doc["repository"]["owner"]["username"], doc["repository"]["name"])
+        if self.headers.get("Authorization") != self.server.data.token_of(repo):
+            return self.reply(400, {"message": "Invalid token"})
+        data = self.server.data
+        with data.lock:
+            data.builds += 1
+            number = data.builds
+            data.started[number] = (repo, time.time())
+            data.peak_running = max(data.peak_running, len(data.running()))
+        self.reply(200, {"number": number, "status": "pending"})
+
+    def handle_repos_repo_builds_number(self, method: str, match, body: bytes) -> None:
+        number = int(match.group(3))
+        with self.server.data.lock:
+            running = number in dict(self.server.data.running())
+        self.reply(200, {"number": number, "status": "running" if running else "success"})
+
+    def handle_repos_repo_branches(self, method: str, match, body: bytes) -> None:
+        branches = self.server.data.heads.get(self.repo_of(match), [])
+        self.reply(200, [{"name": b.name, "commit": {"id": b.sha1, "timestamp": "2017-06-01T12:00:00Z"}}
+                         for b in branches])
+
+    def find_sha1(self, repo: Repo, ref: str) -> str:
+        return next((b.sha1 for b in self.server.data.heads.get(repo, []) if ref in (b.name, b.sha1)), ref)
+
+    def handle_repos_repo_raw_ref_path(self, method: str, match, body: bytes) -> None:
+        repo = self.repo_of(match)
+        dockerfile = self.server.data.dockerfiles.get((repo, self.find_sha1(repo, match.group(3))))
+        if dockerfile is None or match.group(4) != "Dockerfile":
+            return self.reply(404, "Not Found", "text/plain")
+        self.reply(200, dockerfile, "text/plain")
+
+    def handle_repos_repo_git_trees_sha(self, method: str, match, body: bytes) -> None:
+        repo = self.repo_of(match)
+        sha1 = self.find_sha1(repo, match.group(3))
+        tree = [{"path": "README.md", "type": "blob"}]
+        if self.server.data.dockerfiles.get((repo, sha1)) is not None:
+            tree.append({"path": "Dockerfile", "type": "blob"})
+        # paged like Gitea, every page but the last one is truncated
+        query = urllib.parse.parse_qs(urllib.parse.urlsplit(self.path).query)
+        page = int(query.get("page", ["1"])[0])
+        entries = tree[(page - 1) * TREE_PAGE_SIZE:page * TREE_PAGE_SIZE]
+        self.reply(200, {"sha": sha1, "tree": entries, "truncated": page * TREE_PAGE_SIZE < len(tree), "page": page,
+                         "total_count": len(tree)})
+
+    def handle_repos_repo_hooks(self, method: str, match, body: bytes) -> None:
+        url = "http://drone.local/hook?access_token={}".format(self.server.data.token_of(self.repo_of(match)))
+        self.reply(200, [{"id": 1, "type": "gogs", "events": ["push"], "config": {"url": url}}])
+
+
+class EndpointStats(object):
+    def __init__(self) -> None:
+        self.requests = Counter()  # type: Counter
+        self.statuses = Counter()  # type: Counter
+        self.bytes = 0
+        self.lock = threading.Lock()
+
+    def record(self, endpoint: str, status: int, size: int) -> None:
+        with self.lock:
+            self.requests[endpoint] += 1
+            self.statuses[status] += 1
+            self.bytes += size
+
+
+class StubServer(ThreadingMixIn, HTTPServer):
+    daemon_threads = True
+
+    def __init__(self, scenario: Scenario, port: int = 0) -> None:
+        super().__init__(("127.0.0.1", port), StubHandler)
+        self.scenario = scenario
+        self.data = StubData(scenario)
+        self.stats = EndpointStats()
+        self.random = random.Random(scenario.seed)
+        self.thread = None  # type: threading.Thread
+
+    @property
+    def url(self) -> str:
+        return "http://127.0.0.1:{}".format(self.server_address[1])
+
+    @property
+    def drone_api(self) -> str:
+        return self.url + "/drone"
+
+    @property
+    def gogs_api(self) -> str:
+        return self.url + "/gogs"
+
+    def __enter__(self) -> "StubServer":
+        self.thread = threading.Thread(target=self.serve_forever, daemon=True)
+        self.thread.start()
+        return self
+
+    def __exit__(self, *args) -> None:
+        self.shutdown()
+        self.server_close()
+
+
+def serve(scenario: Scenario, ports: multiprocessing.Queue) -> None:
+    server = StubServer(scenario)
+    ports.put(server.server_address[1])
+    server.serve_forever()
+
+
+class StubProcess(object):
+    # runs the stub server in a separate process, so that it neither competes with the plugin for the GIL
+    # nor shows up in its memory usage
+    def __init__(self, scenario: Scenario) -> None:
+        self.scenario = scenario
+        self.process = None  # type: multiprocessing.Process
+        self.url = None  # type: str
+
+    @property
+    def drone_api(self) -> str:
+        return self.url + "/drone"
+
+    @property
+    def gogs_api(self) -> str:
+        return self.url + "/gogs"
+
+    def stats(self) -> dict:
+        with urllib.request.urlopen(self.url + "/_stats") as res:
+            return json.loads(res.read().decode())
+
+    def __enter__(self) -> "StubProcess":
+        ports = multiprocessing.Queue()
+        self.process = multiprocessing.Process(target=serve, args=(self.scenario, ports), daemon=True)
+        self.process.start()
+        self.url = "http://127.0.0.1:{}".format(ports.get(timeout=60))
+        return self
+
+    def __exit__(self, *args) -> None:
+        self.process.terminate()
+        self.process.join()
+
+
+def main() -> None:
+    import argparse
+    parser = argparse.ArgumentParser(description="Serve a generated set of repositories via stub Gogs/Drone APIs.")
+    parser.add_argument("--port", type=int, default=8000)
+    parser.add_argument("--repos", type=int, default=100)
+    parser.add_argument("--branches", type=int, default=4)
+    parser.add_argument("--dockerfile-ratio", type=float, default=0.5)
+    parser.add_argument("--latency", type=float, default=0.0)
+    parser.add_argument("--error-rate", type=float, default=0.0)
+    parser.add_argument("--from", dest="from_", default="base:alpine")
+    parser.add_argument("--build-time", type=float, default=0.0)
+    args = parser.parse_args()
+
+    l.basicConfig(format='%(asctime)s %(levelname)-8s %(message)s', datefmt='%H:%M:%S', level=l.INFO)
+    server = StubServer(scenario(args.repos, args.branches, args.dockerfile_ratio, args.latency, args.error_rate,
+                                 args.from_, build_time=args.build_time), args.port)
+    l.info("Serving drone_api %s and gogs_api %s", server.drone_api, server.gogs_api)
+    server.serve_forever()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,90 @@
+import shutil
+import tempfile
+import time
+import unittest
+from unittest import mock
+
+from cache import StateStore, TriggerLedger
+from repository import Repo, Branch
+
+APP, LIB = Repo("owner", "app"), Repo("owner", "lib")
+
+
+class StateStoreTest(unittest.TestCase):
+    def setUp(self) -> None:
+        self.directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.directory)
+        self.state = StateStore(self.directory, 3600)
+        self.addCleanup(self.state.close)
+
+    def test_lookup_normalizes_the_image(self) -> None:
+        self.state.put_images(APP, Branch("master", "a1"), ["docker.io/library/base:alpine"])
+        self.state.put_images(LIB, Branch("master", "b1"), ["docker.io/library/base:latest"])
+        self.assertEqual(self.state.lookup("base:alpine"), [(APP, Branch("master", "a1"))])
+        self.assertEqual(self.state.lookup("base"), [(LIB, Branch("master", "b1"))])
+
+    def test_lookup_matches_pinned_digests_of_the_tag(self) -> None:
+        self.state.put_images(APP, Branch("master", "a1"), ["docker.io/library/base:alpine@sha256:abc"])
+        self.assertEqual(self.state.lookup("base:alpine"), [(APP, Branch("master", "a1"))])
+        self.assertEqual(self.state.lookup("base:alpine@sha256:def"), [])
+
+    def test_lookup_escapes_wildcards(self) -> None:
+        self.state.put_images(APP, Branch("master", "a1"), ["docker.io/library/base-x:alpine@sha256:abc"])
+        self.assertEqual(self.state.lookup("base_x:alpine"), [])
+        self.assertEqual(self.state.lookup("base-x:alpine"), [(APP, Branch("master", "a1"))])
+
+    def test_evaluated_branches_until(self) -> None:
+        self.state.put_images(APP, Branch("master", "a1"), [])
+        self.state.put_images(APP, Branch("feature", "a2"), [])
+        until = self.state.last_evaluation()
+        # a branch evaluated again, e.g. by a concurrent run, gets a new id even though it was the last one
+        self.state.put_images(APP, Branch("feature", "a2"), ["docker.io/library/base:alpine"])
+        self.state.put_images(APP, Branch("other", "a3"), ["docker.io/library/base:alpine"])
+        self.assertEqual(self.state.evaluated_branches(APP, until), {Branch("master", "a1")})
+        self.assertEqual(self.state.evaluated_branches(LIB, until), set())
+
+    def test_images_of_other_dockerfile_patterns_are_discarded(self) -> None:
+        self.state.put_images(APP, Branch("master", "a1"), ["docker.io/library/base:alpine"])
+        self.state.put_token(APP, "token")
+        self.state.close()
+
+        self.state = StateStore(self.directory, 3600)
+        self.assertEqual(self.state.get_images(APP, Branch("master", "a1")), ["docker.io/library/base:alpine"])
+        self.state.close()
+
+        self.state = StateStore(self.directory, 3600, discovery='["**/Dockerfile"]')
+        self.addCleanup(self.state.close)
+        self.assertIsNone(self.state.get_images(APP, Branch("master", "a1")))
+        self.assertEqual(self.state.get_token(APP), "token")
+
+
+class TriggerLedgerTest(unittest.TestCase):
+    def setUp(self) -> None:
+        self.directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.directory)
+        self.ledger = TriggerLedger(self.directory, 600)
+        self.addCleanup(self.ledger.close)
+        self.branch = Branch("master", "a1")
+
+    def test_commits_are_claimed_once_per_window(self) -> None:
+        self.assertTrue(self.ledger.claim(APP, self.branch, LIB))
+        self.assertFalse(self.ledger.claim(APP, self.branch, LIB))
+        # another commit, branch or upstream repo is a claim of its own
+        self.assertTrue(self.ledger.claim(APP, Branch("master", "a2"), LIB))
+        self.assertTrue(self.ledger.claim(APP, Branch("feature", "a1"), LIB))
+        self.assertTrue(self.ledger.claim(APP, self.branch, Repo("owner", "other")))
+
+    def test_claims_expire_after_the_window(self) -> None:
+        self.assertTrue(self.ledger.claim(APP, self.branch, LIB))
+        with mock.patch("cache.time.time", return_value=time.time() + 601):
+            self.assertTrue(self.ledger.claim(APP, self.branch, LIB))
+            self.assertFalse(self.ledger.claim(APP, self.branch, LIB))
+
+    def test_released_claims_can_be_claimed_again(self) -> None:
+        self.assertTrue(self.ledger.claim(APP, self.branch, LIB))
+        self.ledger.release(APP, self.branch, LIB)
+        self.assertTrue(self.ledger.claim(APP, self.branch, LIB))
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,66 @@
+import unittest
+
+from cascade import plan_cascade
+from repository import Repo, Branch
+
+SOURCE = Repo("owner", "base")
+
+
+def image_of_repo(repo: Repo) -> str:
+    return "registry.example.com/{}/{}".format(repo.owner, repo.name)
+
+
+def branch(name: str) -> Branch:
+    return Branch(name, "sha1-of-" + name)
+
+
+class PlanCascadeTest(unittest.TestCase):
+    def test_waves_follow_the_longest_path(self) -> None:
+        # app depends on base directly and on lib, which depends on base itself
+        lib, app, unrelated = Repo("owner", "lib"), Repo("owner", "app"), Repo("owner", "unrelated")
+        images_of_branches = {
+            SOURCE: [(branch("master"), ["docker.io/library/alpine:3"])],
+            lib: [(branch("master"), ["registry.example.com/owner/base:latest"])],
+            app: [(branch("master"), ["registry.example.com/owner/base:latest",
+                                      "registry.example.com/owner/lib:latest"])],
+            unrelated: [(branch("master"), ["docker.io/library/debian:9"])],
+        }
+        plan = plan_cascade(images_of_branches, ["registry.example.com/owner/base"], SOURCE, image_of_repo)
+        self.assertEqual(plan.waves, [{lib: [branch("master")]}, {app: [branch("master")]}])
+        self.assertEqual(plan.parents, {lib: {None}, app: {None, lib}})
+
+    def test_only_branches_based_on_a_parent_are_built(self) -> None:
+        lib, app = Repo("owner", "lib"), Repo("owner", "app")
+        images_of_branches = {
+            lib: [(branch("master"), ["base:alpine"]), (branch("legacy"), ["debian:9"])],
+            app: [(branch("master"), ["registry.example.com/owner/lib:1"]), (branch("other"), ["debian:9"])],
+        }
+        plan = plan_cascade(images_of_branches, ["base:alpine"], SOURCE, image_of_repo)
+        self.assertEqual(plan.waves, [{lib: [branch("master")]}, {app: [branch("master")]}])
+
+    def test_source_and_self_references_are_ignored(self) -> None:
+        app = Repo("owner", "app")
+        images_of_branches = {
+            SOURCE: [(branch("master"), ["base:alpine"])],
+            app: [(branch("master"), ["base:alpine", "registry.example.com/owner/app:builder"])],
+        }
+        plan = plan_cascade(images_of_branches, ["base:alpine"], SOURCE, image_of_repo)
+        self.assertEqual(plan.waves, [{app: [branch("master")]}])
+
+    def test_cycles_are_not_cascaded(self) -> None:
+        a, b, c = Repo("owner", "a"), Repo("owner", "b"), Repo("owner", "c")
+        images_of_branches = {
+            a: [(branch("master"), ["base:alpine"])],
+            b: [(branch("master"), ["registry.example.com/owner/a", "registry.example.com/owner/c"])],
+            c: [(branch("master"), ["registry.example.com/owner/b"])],
+        }
+        plan = plan_cascade(images_of_branches, ["base:alpine"], SOURCE, image_of_repo)
+        self.assertEqual(plan.waves, [{a: [branch("master")]}])
+
+    def test_nothing_depends_on_the_images(self) -> None:
+        images_of_branches = {Repo("owner", "app"): [(branch("master"), ["debian:9"])]}
+        self.assertEqual(plan_cascade(images_of_branches, ["base:alpine"], SOURCE, image_of_repo).waves, [])
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,92 @@
+import unittest
+
+from dockerfile import image_matches, matching_from, normalize_image, parse_from_images, read_enough, READ_AHEAD
+
+
+class ParseFromImagesTest(unittest.TestCase):
+    def test_single_from(self) -> None:
+        self.assertEqual(parse_from_images("FROM base:alpine\nRUN true\n"), ["docker.io/library/base:alpine"])
+
+    def test_keyword_is_case_insensitive(self) -> None:
+        self.assertEqual(parse_from_images("from base\n"), ["docker.io/library/base:latest"])
+
+    def test_multi_stage_skips_earlier_stages_and_scratch(self) -> None:
+        dockerfile = "FROM golang:1.10 AS build\nRUN make\n" \
+                     "FROM build AS test\n" \
+                     "FROM scratch\nCOPY --from=build /app /app\n" \
+                     "FROM example.org:5000/team/runtime\n"
+        self.assertEqual(parse_from_images(dockerfile),
+                         ["docker.io/library/golang:1.10", "example.org:5000/team/runtime:latest"])
+
+    def test_same_image_is_listed_once(self) -> None:
+        self.assertEqual(parse_from_images("FROM base AS a\nFROM base AS b\n"), ["docker.io/library/base:latest"])
+
+    def test_platform_flag(self) -> None:
+        self.assertEqual(parse_from_images("FROM --platform=linux/amd64 base:alpine AS build\n"),
+                         ["docker.io/library/base:alpine"])
+
+    def test_arg_substitution(self) -> None:
+        dockerfile = "ARG REGISTRY=registry.example.com\nARG TAG\n" \
+                     "FROM $REGISTRY/base:${TAG:-alpine}\n" \
+                     "ARG LATE=ignored\nFROM ${LATE:-fallback}\n"
+        self.assertEqual(parse_from_images(dockerfile),
+                         ["registry.example.com/base:alpine", "docker.io/library/fallback:latest"])
+
+    def test_line_continuation_and_comments(self) -> None:
+        dockerfile = "# a comment\nFROM \\\n    base:alpine\n# FROM commented:out\n"
+        self.assertEqual(parse_from_images(dockerfile), ["docker.io/library/base:alpine"])
+
+    def test_escape_directive(self) -> None:
+        self.assertEqual(parse_from_images("# escape=`\nFROM `\n  base:alpine\n"), ["docker.io/library/base:alpine"])
+
+    def test_missing_from(self) -> None:
+        self.assertEqual(parse_from_images("RUN true\n"), [])
+
+
+class NormalizeImageTest(unittest.TestCase):
+    def test_official_image(self) -> None:
+        self.assertEqual(normalize_image("base"), "docker.io/library/base:latest")
+        self.assertEqual(normalize_image("index.docker.io/library/base:1"), "docker.io/library/base:1")
+
+    def test_namespace_and_registry(self) -> None:
+        self.assertEqual(normalize_image("owner/base:1"), "docker.io/owner/base:1")
+        self.assertEqual(normalize_image("localhost/base"), "localhost/base:latest")
+        self.assertEqual(normalize_image("Example.org:5000/Base"), "example.org:5000/base:latest")
+
+    def test_digest(self) -> None:
+        self.assertEqual(normalize_image("base@sha256:abc"), "docker.io/library/base@sha256:abc")
+        self.assertEqual(normalize_image("base:1@sha256:abc"), "docker.io/library/base:1@sha256:abc")
+
+
+class MatchingTest(unittest.TestCase):
+    def test_plain_image(self) -> None:
+        self.assertTrue(image_matches("docker.io/library/base:alpine", "base:alpine"))
+        self.assertFalse(image_matches("docker.io/library/base:alpine", "base"))
+
+    def test_pinned_digest_matches_its_tag(self) -> None:
+        self.assertTrue(image_matches("base:alpine@sha256:abc", "base:alpine"))
+        self.assertFalse(image_matches("base:alpine@sha256:abc", "base:alpine@sha256:def"))
+
+    def test_patterns(self) -> None:
+        self.assertTrue(image_matches("base:alpine", "base:*"))
+        self.assertTrue(image_matches("base:alpine", "ba?e"))
+        self.assertTrue(image_matches("registry.example.com/team/base:1", "registry.example.com/*"))
+        self.assertFalse(image_matches("other:alpine", "base*"))
+
+    def test_matching_from_returns_first_wanted_image(self) -> None:
+        images = ["docker.io/library/golang:1.10", "docker.io/library/base:alpine"]
+        self.assertEqual(matching_from(images, ["other", "base:*", "golang:1.10"]), "base:*")
+        self.assertIsNone(matching_from(images, ["other"]))
+
+
+class ReadEnoughTest(unittest.TestCase):
+    def test_small_dockerfiles_are_read_completely(self) -> None:
+        self.assertFalse(read_enough(b"FROM base\n"))
+
+    def test_large_dockerfiles_stop_after_from(self) -> None:
+        self.assertTrue(read_enough(b"FROM base\n" + b"#" * READ_AHEAD))
+        self.assertFalse(read_enough(b"#" * READ_AHEAD))
+
+
+if __name__ == "__main__":
+    unittest.main()
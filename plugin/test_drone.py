@@ -0,0 +1,83 @@
+import json
+import os
+import shutil
+import tempfile
+import threading
+import time
+import unittest
+from unittest import mock
+
+import configuration
+from drone import DroneClient, JsonTemplate
+from remote import Json, Requester
+from repository import Repo
+from stub import StubServer, scenario
+from trigger import create_plugin
+
+
+def json_format(original: Json, **kwargs: str) -> Json:
+    # how hook bodies used to be rendered, by formatting every string of the template
+    if isinstance(original, list):
+        return [json_format(value, **kwargs) for value in original]
+    elif isinstance(original, dict):
+        return {key.format(**kwargs): json_format(value, **kwargs) for key, value in original.items()}
+    elif isinstance(original, str):
+        return original.format(**kwargs)
+    return original
+
+
+class JsonTemplateTest(unittest.TestCase):
+    def test_hook_body_is_unchanged(self) -> None:
+        values = dict(owner="owner", name="app", branch='feature/"quoted" \\ back\\slash', commit="a" * 40,
+                      source="owner/base (base:alpine) \u00fcnicode\ttab\n")
+        rendered = DroneClient.TRIGGER_BODY.render(**values)
+        self.assertEqual(rendered, json.dumps(json_format(DroneClient.TRIGGER_TEMPLATE, **values)).encode())
+
+    def test_placeholders_in_keys_and_lists(self) -> None:
+        template = JsonTemplate({"{key}": ["{a}", 1, None, {"b": "x{a}y"}]})
+        self.assertEqual(json.loads(template.render(key="k", a='"')), {"k": ['"', 1, None, {"b": 'x"y'}]})
+
+
+class MaxRunningBuildsTest(unittest.TestCase):
+    def setUp(self) -> None:
+        self.stub = StubServer(scenario(repos=20, branches=1, dockerfile_ratio=1.0, build_time=2)).__enter__()
+        self.addCleanup(self.stub.__exit__)
+        self.cache_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.cache_dir)
+
+    def test_builds_are_started_as_capacity_frees_up(self) -> None:
+        environment = {"PLUGIN_DRONE_API": self.stub.drone_api, "PLUGIN_GOGS_API": self.stub.gogs_api,
+                       "PLUGIN_CACHE_DIR": self.cache_dir, "PLUGIN_CONCURRENCY": "4",
+                       "PLUGIN_MAX_RUNNING_BUILDS": "2", "PLUGIN_BUILD_POLL_INTERVAL": "1"}
+        with mock.patch.dict(os.environ, environment, clear=True):
+            config = configuration.Config.create_from_env()
+        plugin, close = create_plugin(config)
+        self.addCleanup(close)
+
+        run = threading.Thread(target=plugin.run, args=(["base:alpine"], Repo("owner", "base"), False), daemon=True)
+        run.start()
+        run.join(60)
+        self.assertFalse(run.is_alive(), "the run is stuck waiting for capacity")
+        # every even repo is based on base:alpine
+        self.assertEqual(self.stub.data.builds, 10)
+        self.assertLessEqual(self.stub.data.peak_running, 2)
+
+
+class WaitForBuildsTest(unittest.TestCase):
+    def test_waiting_stops_at_the_run_deadline(self) -> None:
+        stub = StubServer(scenario(repos=1, branches=1, build_time=60)).__enter__()
+        self.addCleanup(stub.__exit__)
+        requester = Requester(timeout=5, deadline=time.monotonic() + 1)
+        self.addCleanup(requester.close)
+        drone = DroneClient(requester, stub.drone_api)
+        repo = stub.data.repos[0]
+        number = drone.send_branch_build(repo, stub.data.heads[repo][0], Repo("owner", "base"),
+                                         stub.data.token_of(repo))
+
+        started = time.monotonic()
+        self.assertEqual(drone.wait_for_builds({repo: [number]}, 3600, 10), set())
+        self.assertLess(time.monotonic() - started, 5)
+
+
+if __name__ == "__main__":
+    unittest.main()
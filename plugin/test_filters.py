@@ -0,0 +1,57 @@
+import unittest
+
+from filters import TargetFilter, compile_branch_pattern, parse_timestamp
+from repository import Repo
+
+
+class CompileBranchPatternTest(unittest.TestCase):
+    def test_glob(self) -> None:
+        pattern = compile_branch_pattern("dependabot/*")
+        self.assertTrue(pattern.match("dependabot/pip/requests-2.20"))
+        self.assertFalse(pattern.match("master"))
+        self.assertFalse(compile_branch_pattern("release").match("release-1"))
+
+    def test_regex(self) -> None:
+        pattern = compile_branch_pattern("/release-\\d+/")
+        self.assertTrue(pattern.match("release-12"))
+        self.assertFalse(pattern.match("release-x"))
+
+    def test_single_slash_is_a_glob(self) -> None:
+        self.assertTrue(compile_branch_pattern("/").match("/"))
+
+
+class ParseTimestampTest(unittest.TestCase):
+    def test_utc(self) -> None:
+        self.assertEqual(parse_timestamp("2017-06-01T12:00:00Z"), 1496318400)
+
+    def test_offset(self) -> None:
+        self.assertEqual(parse_timestamp("2017-06-01T14:00:00+02:00"), 1496318400)
+        self.assertEqual(parse_timestamp("2017-06-01T10:00:00-0200"), 1496318400)
+
+    def test_fractional_seconds(self) -> None:
+        self.assertEqual(parse_timestamp("2017-06-01T12:00:00.123456Z"), 1496318400)
+
+    def test_invalid(self) -> None:
+        self.assertIsNone(parse_timestamp(None))
+        self.assertIsNone(parse_timestamp("2017-06-01 12:00:00"))
+        self.assertIsNone(parse_timestamp("2017-06-01T12:00:00"))
+
+
+class TargetFilterTest(unittest.TestCase):
+    def test_repos(self) -> None:
+        targets = TargetFilter(include_repos=["owner/*"], exclude_repos=["owner/legacy-*"], active_only=True)
+        self.assertTrue(targets.accepts_repo(Repo("owner", "app")))
+        self.assertFalse(targets.accepts_repo(Repo("owner", "legacy-app")))
+        self.assertFalse(targets.accepts_repo(Repo("other", "app")))
+        self.assertFalse(targets.accepts_repo(Repo("owner", "app"), active=False))
+
+    def test_branches(self) -> None:
+        targets = TargetFilter(exclude_branches=["dependabot/*", "/^wip-/"], max_commit_age=60)
+        self.assertTrue(targets.accepts_branch("master"))
+        self.assertFalse(targets.accepts_branch("dependabot/npm/left-pad"))
+        self.assertFalse(targets.accepts_branch("wip-feature"))
+        self.assertFalse(targets.accepts_branch("master", committed=0))
+
+
+if __name__ == "__main__":
+    unittest.main()
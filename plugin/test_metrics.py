@@ -0,0 +1,40 @@
+import threading
+import time
+import unittest
+
+from metrics import Metrics
+
+
+class PhaseTest(unittest.TestCase):
+    def test_overlapping_phases_count_wall_clock_time(self) -> None:
+        metrics = Metrics()
+
+        def work() -> None:
+            with metrics.phase("dockerfiles"):
+                time.sleep(0.2)
+
+        threads = [threading.Thread(target=work) for _ in range(4)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.assertGreaterEqual(metrics.phases["dockerfiles"], 0.2)
+        self.assertLess(metrics.phases["dockerfiles"], 0.6)
+
+    def test_separate_intervals_add_up(self) -> None:
+        metrics = Metrics()
+        for _ in range(2):
+            with metrics.phase("triggers"):
+                time.sleep(0.05)
+        self.assertGreaterEqual(metrics.phases["triggers"], 0.1)
+
+    def test_active_phases_are_reported(self) -> None:
+        metrics = Metrics()
+        with metrics.phase("waiting"):
+            time.sleep(0.05)
+            self.assertGreaterEqual(metrics.to_json()["phases"]["waiting"], 0.05)
+        self.assertIn('phase="waiting"', metrics.to_prometheus())
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,50 @@
+import json
+import os
+import shutil
+import tempfile
+import unittest
+
+from drone import BuildTrigger
+from plan import read_plan, write_plan
+from repository import Repo, Branch
+
+SOURCE = Repo("owner", "base")
+
+
+class PlanTest(unittest.TestCase):
+    def setUp(self) -> None:
+        directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, directory)
+        self.path = os.path.join(directory, "plan.json")
+
+    def test_round_trip(self) -> None:
+        app, lib = Repo("owner", "app"), Repo("team", "lib")
+        triggers = {
+            app: BuildTrigger([Branch("master", "a1"), Branch("feature", "a2")], "secret", {"master": "base:*"}),
+            lib: BuildTrigger([Branch("master", "b1")], "secret", {"master": "base:alpine"}),
+        }
+        write_plan(self.path, SOURCE, ["base:alpine", "base:*"], triggers)
+        with open(self.path) as f:
+            self.assertNotIn("secret", f.read())
+
+        plan = read_plan(self.path)
+        self.assertEqual(plan.source, SOURCE)
+        self.assertEqual(plan.froms, ["base:alpine", "base:*"])
+        self.assertEqual(plan.branches, {app: [Branch("master", "a1"), Branch("feature", "a2")],
+                                         lib: [Branch("master", "b1")]})
+        self.assertEqual(plan.matched, {app: {Branch("master", "a1"): "base:*"},
+                                        lib: {Branch("master", "b1"): "base:alpine"}})
+
+    def test_unsupported_versions_are_rejected(self) -> None:
+        write_plan(self.path, SOURCE, ["base:alpine"], {})
+        with open(self.path) as f:
+            doc = json.load(f)
+        doc["version"] += 1
+        with open(self.path, "w") as f:
+            json.dump(doc, f)
+        with self.assertRaises(SystemExit):
+            read_plan(self.path)
+
+
+if __name__ == "__main__":
+    unittest.main()
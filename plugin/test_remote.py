@@ -0,0 +1,236 @@
+import gzip
+import random
+import shutil
+import tempfile
+import threading
+import time
+import unittest
+import zlib
+from http.server import BaseHTTPRequestHandler, HTTPServer
+from socketserver import ThreadingMixIn
+from typing import Dict
+
+from cache import ResponseCache
+from remote import Client, ClientException, Decompressor, RateLimiter, Requester, RequesterException, \
+    ResponseTooLargeException
+
+LINES = b"".join(b"line %d\n" % i for i in range(1000))
+
+
+def raw_deflate(data: bytes) -> bytes:
+    compressor = zlib.compressobj(wbits=-zlib.MAX_WBITS)
+    return compressor.compress(data) + compressor.flush()
+
+
+class LocalHandler(BaseHTTPRequestHandler):
+    def log_message(self, format, *args) -> None:
+        pass
+
+    def reply(self, code: int, body: bytes = b"", headers: Dict[str, str] = None) -> None:
+        self.send_response(code)
+        for key, value in (headers or {}).items():
+            self.send_header(key, value)
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def count(self) -> int:
+        with self.server.lock:
+            self.server.requests[self.path] = self.server.requests.get(self.path, 0) + 1
+            return self.server.requests[self.path]
+
+    def do_POST(self) -> None:
+        self.count()
+        self.rfile.read(int(self.headers.get("Content-Length") or 0))
+        self.reply(503)
+
+    def do_GET(self) -> None:
+        count = self.count()
+        if self.path == "/flaky":
+            self.reply(503 if count == 1 else 200, b"ok")
+        elif self.path == "/slow":
+            # only the first request is slow, as if it had hit an overloaded backend
+            if count == 1:
+                time.sleep(2)
+            self.reply(200, b"attempt %d" % count)
+        elif self.path == "/gzip":
+            self.reply(200, gzip.compress(LINES), {"Content-Encoding": "gzip"})
+        elif self.path == "/deflate":
+            self.reply(200, raw_deflate(LINES), {"Content-Encoding": "deflate"})
+        elif self.path == "/lines":
+            self.reply(200, LINES)
+        elif self.path.startswith("/listing"):
+            if self.headers.get("If-None-Match") == '"v1"':
+                self.reply(304, headers={"ETag": '"v1"'})
+            else:
+                self.reply(200, b'["a","b"]', {"ETag": '"v1"', "Content-Type": "application/json"})
+        else:
+            self.reply(404)
+
+
+class LocalServer(ThreadingMixIn, HTTPServer):
+    daemon_threads = True
+
+    def __init__(self) -> None:
+        super().__init__(("127.0.0.1", 0), LocalHandler)
+        self.requests = {}  # type: Dict[str, int]
+        self.lock = threading.Lock()
+        threading.Thread(target=self.serve_forever, daemon=True).start()
+
+    @property
+    def url(self) -> str:
+        return "http://127.0.0.1:{}".format(self.server_address[1])
+
+    def close(self) -> None:
+        self.shutdown()
+        self.server_close()
+
+
+class ServerTestCase(unittest.TestCase):
+    def setUp(self) -> None:
+        self.server = LocalServer()
+        self.addCleanup(self.server.close)
+
+    def requester(self, **kwargs) -> Requester:
+        requester = Requester(timeout=5, **kwargs)
+        self.addCleanup(requester.close)
+        return requester
+
+
+class PathOfTest(unittest.TestCase):
+    def setUp(self) -> None:
+        self.client = Client(Requester(), "http://drone:8000/api")
+
+    def test_links_to_another_host_stay_on_the_configured_one(self) -> None:
+        self.assertEqual(self.client.path_of("https://drone.example.com/api/user/repos?page=2"), "/user/repos?page=2")
+
+    def test_links_outside_of_the_api_are_refused(self) -> None:
+        for url in ("http://drone:8000/login", "http://drone:8000/apix/user/repos"):
+            with self.assertRaises(ClientException):
+                self.client.path_of(url)
+
+    def test_no_link(self) -> None:
+        self.assertIsNone(self.client.path_of(None))
+
+
+class RateLimiterTest(unittest.TestCase):
+    def test_mixed_latencies_keep_the_rate(self) -> None:
+        limiter = RateLimiter(100)
+        generator = random.Random(0)
+        endpoints = {"/hook": 0.004, "/repos/{repo}/branches": 0.02, "/repos/{repo}/git/trees/{sha}": 0.05}
+        for _ in range(2000):
+            endpoint = generator.choice(list(endpoints))
+            limiter.observe(200, endpoints[endpoint] * generator.choice([0.5, 1, 2]), endpoint)
+            limiter.observe(200, generator.choice([0.004, 0.02, 0.05]), "/repos/{repo}/raw/{ref}/{path}")
+        self.assertEqual(limiter.rate, 100)
+
+    def test_overload_halves_the_rate_once_per_window(self) -> None:
+        limiter = RateLimiter(100)
+        for _ in range(10):
+            limiter.observe(503, 0.01)
+        self.assertEqual(limiter.rate, 50)
+        limiter.decreased -= RateLimiter.WINDOW
+        limiter.observe(None, 0.01)
+        self.assertEqual(limiter.rate, 25)
+        limiter.observe(200, 0.01)
+        self.assertEqual(limiter.rate, 30)
+
+    def test_sustained_latency_rise_backs_off(self) -> None:
+        limiter = RateLimiter(100)
+        for _ in range(100):
+            limiter.observe(200, 0.01, "/user/repos")
+        for _ in range(30):
+            limiter.observe(200, 0.2, "/user/repos")
+        self.assertEqual(limiter.rate, 50)
+
+
+class RetryTest(ServerTestCase):
+    def requester(self, **kwargs) -> Requester:
+        requester = super().requester(**kwargs)
+        # retries need not wait long for the local server
+        requester.BACKOFF_BASE = 0.01
+        return requester
+
+    def test_server_errors_are_retried(self) -> None:
+        self.assertEqual(self.requester(retries=2).request(self.server.url + "/flaky"), "ok")
+        self.assertEqual(self.server.requests["/flaky"], 2)
+
+    def test_client_errors_are_not_retried(self) -> None:
+        with self.assertRaises(RequesterException) as context:
+            self.requester(retries=2).request(self.server.url + "/missing")
+        self.assertEqual(context.exception.getcode(), 404)
+        self.assertEqual(self.server.requests["/missing"], 1)
+
+    def test_posts_are_never_retried(self) -> None:
+        with self.assertRaises(RequesterException) as context:
+            self.requester(retries=2).request(self.server.url + "/post", data=b"{}")
+        self.assertEqual(context.exception.getcode(), 503)
+        self.assertEqual(self.server.requests["/post"], 1)
+
+    def test_hedge_answers_before_a_slow_request(self) -> None:
+        started = time.monotonic()
+        self.assertEqual(self.requester(hedge_after=0.1).request(self.server.url + "/slow"), "attempt 2")
+        self.assertLess(time.monotonic() - started, 1.5)
+        self.assertEqual(self.server.requests["/slow"], 2)
+
+
+class DecompressorTest(unittest.TestCase):
+    def test_gzip(self) -> None:
+        decompressor = Decompressor("gzip")
+        self.assertEqual(decompressor.decompress(gzip.compress(LINES), len(LINES)) + decompressor.flush(), LINES)
+
+    def test_raw_deflate_fallback(self) -> None:
+        decompressor = Decompressor("deflate")
+        self.assertEqual(decompressor.decompress(raw_deflate(LINES), len(LINES)) + decompressor.flush(), LINES)
+
+    def test_output_is_bounded(self) -> None:
+        decompressor = Decompressor("deflate")
+        self.assertEqual(len(decompressor.decompress(zlib.compress(LINES), 100)), 100)
+        self.assertTrue(decompressor.unconsumed_tail)
+
+
+class ReadBodyTest(ServerTestCase):
+    def test_compressed_bodies_are_decoded(self) -> None:
+        for path in ("/gzip", "/deflate"):
+            res = self.requester().request_response(self.server.url + path)
+            self.assertEqual(res.body, LINES)
+            self.assertLess(res.size, len(LINES))
+
+    def test_bodies_beyond_the_limit_are_refused(self) -> None:
+        for path in ("/gzip", "/lines"):
+            with self.assertRaises(RequesterException) as context:
+                self.requester(max_body_size=1000).request_response(self.server.url + path)
+            self.assertIsInstance(context.exception.__cause__, ResponseTooLargeException)
+
+    def test_reading_stops_after_enough_complete_lines(self) -> None:
+        res = self.requester().request_response(self.server.url + "/gzip", enough=lambda body: len(body) >= 100)
+        self.assertTrue(res.truncated)
+        self.assertTrue(LINES.startswith(res.body))
+        self.assertTrue(res.body.endswith(b"\n"))
+        self.assertGreaterEqual(len(res.body), 90)
+
+
+class RevalidationTest(ServerTestCase):
+    def setUp(self) -> None:
+        super().setUp()
+        directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, directory)
+        self.responses = ResponseCache(directory, 10)
+        self.addCleanup(self.responses.close)
+
+    def test_unchanged_listings_are_replayed_from_the_cache(self) -> None:
+        requester = self.requester(responses=self.responses)
+        first = requester.request_response(self.server.url + "/listing", revalidate=True)
+        second = requester.request_response(self.server.url + "/listing", revalidate=True)
+        self.assertEqual((first.status, second.status), (200, 304))
+        self.assertEqual(second.body, b'["a","b"]')
+        self.assertEqual(second.headers.get_content_type(), "application/json")
+
+    def test_other_responses_are_not_cached(self) -> None:
+        requester = self.requester(responses=self.responses)
+        requester.request_response(self.server.url + "/listing-of-a-commit")
+        self.assertIsNone(self.responses.get(self.server.url + "/listing-of-a-commit"))
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,110 @@
+import json
+import os
+import shutil
+import socket
+import sqlite3
+import tempfile
+import threading
+import time
+import unittest
+from unittest import mock
+
+import configuration
+from remote import Client, Requester
+from server import DownstreamService, ServiceServer
+from stub import StubServer, scenario
+from trigger import create_plugin, trigger_via_service
+
+
+class ServiceTest(unittest.TestCase):
+    # the service against the stub Gogs and Drone APIs, as Gogs' push webhooks and the plugin step would call it
+    def setUp(self) -> None:
+        self.stub = StubServer(scenario(repos=10, branches=2, dockerfile_ratio=1.0)).__enter__()
+        self.addCleanup(self.stub.__exit__)
+        self.cache_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.cache_dir)
+
+        environment = {"PLUGIN_DRONE_API": self.stub.drone_api, "PLUGIN_GOGS_API": self.stub.gogs_api,
+                       "PLUGIN_CACHE_DIR": self.cache_dir, "PLUGIN_RESPONSE_CACHE_ENTRIES": "3",
+                       "PLUGIN_SERVER_PORT": "0"}
+        with mock.patch.dict(os.environ, environment, clear=True):
+            config = configuration.Config.create_from_env()
+        plugin, close = create_plugin(config)
+        self.addCleanup(close)
+        self.service = DownstreamService(plugin)
+        self.service.refresh()
+
+        self.server = ServiceServer(config, self.service)
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+        self.addCleanup(self.server.server_close)
+        self.addCleanup(self.server.shutdown)
+        self.client = Client(Requester(timeout=10), "http://127.0.0.1:{}".format(self.server.server_address[1]),
+                             {"Content-Type": "application/json; charset=utf-8"})
+
+    def push(self, repo_index: int, branch_name: str, dockerfile: str = None) -> None:
+        payload = self.stub.data.push(self.stub.data.repos[repo_index], branch_name, dockerfile)
+        self.client.request_json("/hooks/gogs", json.dumps(payload).encode(), {"X-Gogs-Event": "push"})
+
+    def trigger(self, dry_run: bool = False) -> dict:
+        request = {"from": ["base:alpine"], "source": "owner/base", "dry_run": dry_run}
+        return self.client.request_json("/trigger", json.dumps(request).encode())
+
+    def test_trigger_uses_the_index(self) -> None:
+        doc = self.trigger()
+        # every even repo is based on base:alpine, both of its branches are triggered
+        self.assertEqual(doc["triggered"], 10)
+        self.assertEqual(self.stub.data.builds, 10)
+        self.assertIn("owner0/repo0[", doc["targets"])
+        self.assertNotIn("owner1/repo1[", doc["targets"])
+
+    def test_pushes_update_the_index(self) -> None:
+        self.push(1, "feature", "FROM base:alpine\n")
+        self.push(0, "master", "FROM other:1\n")
+        doc = self.trigger(dry_run=True)
+        self.assertIn("owner1/repo1[feature]", doc["targets"])
+        self.assertIn("owner0/repo0[branch1]", doc["targets"])
+        self.assertEqual(doc["triggered"], 0)
+        self.assertEqual(self.stub.data.builds, 0)
+
+    def test_deleted_branches_leave_the_index(self) -> None:
+        repo = self.stub.data.repos[0]
+        master = self.stub.data.heads[repo][0]
+        payload = self.stub.data.delete(repo, "master")
+        self.client.request_json("/hooks/gogs", json.dumps(payload).encode(), {"X-Gogs-Event": "delete"})
+        doc = self.trigger(dry_run=True)
+        self.assertNotIn("owner0/repo0[master", doc["targets"])
+        self.assertIn("owner0/repo0[branch1]", doc["targets"])
+        self.assertIsNone(self.service.plugin.state.get_images(repo, master))
+
+    def test_pushes_only_fetch_the_pushed_branch(self) -> None:
+        before = dict(self.stub.stats.requests)
+        self.push(2, "feature", "FROM base:alpine\n")
+        requests = {endpoint: count - before.get(endpoint, 0) for endpoint, count in self.stub.stats.requests.items()
+                    if count != before.get(endpoint, 0)}
+        self.assertEqual(requests, {"gogs /repos/{repo}/raw/{ref}/{path}": 1})
+
+    def test_refresh_evicts_the_caches(self) -> None:
+        self.service.refresh()
+        with sqlite3.connect(os.path.join(self.cache_dir, "responses.sqlite")) as db:
+            self.assertLessEqual(db.execute("SELECT COUNT(*) FROM responses").fetchone()[0], 3)
+
+
+class ServiceClientTest(unittest.TestCase):
+    def test_unresponsive_service_times_out(self) -> None:
+        # accepts the connection but never answers
+        listener = socket.socket()
+        self.addCleanup(listener.close)
+        listener.bind(("127.0.0.1", 0))
+        listener.listen(1)
+        environment = {"PLUGIN_SERVER_URL": "http://127.0.0.1:{}".format(listener.getsockname()[1]),
+                       "PLUGIN_FROM": "base:alpine", "DRONE_REPO": "owner/base", "PLUGIN_REQUEST_TIMEOUT": "1"}
+        with mock.patch.dict(os.environ, environment, clear=True):
+            config = configuration.Config.create_from_env()
+        started = time.monotonic()
+        with self.assertRaises(SystemExit):
+            trigger_via_service(config)
+        self.assertLess(time.monotonic() - started, 10)
+
+
+if __name__ == "__main__":
+    unittest.main()
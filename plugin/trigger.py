@@ -1,75 +1,300 @@
 #!/usr/bin/env python3
 
+import json
 import logging as l
+import time
+from concurrent.futures import Future, ThreadPoolExecutor
 
 import configuration
+from cache import DockerfileCache, ResponseCache, StateStore, TriggerLedger
+from cascade import plan_cascade
+from dockerfile import is_pattern, matching_from
 from drone import DroneClient, BuildTrigger
+from executor import Executor
+from filters import TargetFilter
 from gogs import GogsClient, DockerImageSearcher
-from repository import Repo
-from remote import ClientException, Requester
-from typing import Union, Dict
+from metrics import Metrics
+from plan import Plan, read_plan, write_plan
+from repository import Repo, Branch
+from remote import Client, ClientException, Requester, ConnectionPool
+from typing import Union, Dict, Iterator, Tuple, Optional, List, Set, Callable, NamedTuple
 
 # types
 from repository import Repos, BranchesOfRepos, Branches
 from drone import BuildTriggers
+from cascade import ImagesOfBranches
+
+# the branches the state's image index lists as based on one of the wanted images, and the wanted image each of them
+# matched, valid for branches evaluated up to the last evaluation before it was looked up
+Downstream = NamedTuple("Downstream", [("matched", Dict[Tuple[Repo, Branch], str]), ("evaluated_until", int)])
 
 
 class TriggerPlugin(object):
-    def __init__(self, drone: DroneClient, gogs: GogsClient, searcher: DockerImageSearcher) -> None:
+    def __init__(self, drone: DroneClient, gogs: GogsClient, searcher: DockerImageSearcher,
+                 executor: Executor = None, state: StateStore = None, metrics: Metrics = None,
+                 prefetch_tokens: bool = False, targets: TargetFilter = None) -> None:
         self.drone = drone
         self.gogs = gogs
         self.searcher = searcher
+        self.executor = executor or Executor()
+        self.state = state
+        self.metrics = metrics or Metrics()
+        self.prefetch_tokens = prefetch_tokens
+        self.targets = targets or TargetFilter()
 
-    def run(self, from_: str, source: Repo, dry_run: bool) -> None:
-        l.info("Triggering builds of Docker repositories with FROM instruction '%s'.", from_)
+    def run(self, froms: List[str], source: Repo, dry_run: bool, collapse: bool = False,
+            plan_file: str = None) -> None:
+        l.info("Triggering builds of Docker repositories with FROM instruction %s.", list_images(froms))
 
-        repos = self.drone.retrieve_repos()
-        branches_of_repos = self.get_branches_of_repos(repos)
-        verbose(self.log_potential_targets, branches_of_repos)
+        def run_repo(repo: Repo) -> Tuple[Repo, Optional[Tuple[BuildTrigger, int]]]:
+            return repo, self.run_repo(repo, froms, source, dry_run, collapse, prefetcher, downstream)
+
+        # every repo passes through the whole pipeline as soon as Drone lists it, only counters are kept,
+        # and the build triggers if they are written to a plan
+        repos_triggered, builds_triggered = 0, 0
+        planned = {}  # type: BuildTriggers
+        with self.metrics.phase("dockerfiles"):
+            downstream = self.look_up_downstream(froms)
+        prefetcher = ThreadPoolExecutor(max_workers=self.executor.workers) if self.prefetch_tokens else None
+        try:
+            repos = self.until_deadline(self.drone.iterate_repos(self.targets))
+            for repo, outcome in self.executor.map(run_repo, self.metrics.timed("repos", repos)):
+                if outcome is not None:
+                    build_trigger, triggered = outcome
+                    repos_triggered += 1
+                    builds_triggered += triggered
+                    if plan_file:
+                        planned[repo] = build_trigger
+        finally:
+            if prefetcher:
+                prefetcher.shutdown()
+
+        if plan_file:
+            write_plan(plan_file, source, froms, planned)
+        if not repos_triggered:
+            l.info("There are no builds to trigger.")
+        if dry_run:
+            l.info("Aborted execution, this was only a dry run.")
+        verbose(self.targets.log_savings)
+        verbose(self.log_builds_triggered, builds_triggered)
+
+    def look_up_downstream(self, froms: List[str]) -> Optional[Downstream]:
+        # plain images are answered by the image index, patterns have to be matched against the images of every branch
+        if not self.state or any(is_pattern(from_) for from_ in froms):
+            return None
+        evaluated_until = self.state.last_evaluation()
+        matched = {}  # type: Dict[Tuple[Repo, Branch], str]
+        for from_ in froms:
+            for target in self.state.lookup(from_):
+                matched.setdefault(target, from_)
+        l.debug("Found %s branches based on %s in the image index.", len(matched), list_images(froms))
+        return Downstream(matched, evaluated_until)
+
+    def evict(self) -> None:
+        # drops what exceeds the age and size limits of the caches
+        for store in (self.gogs.cache, self.state, self.drone.ledger, self.drone.requester.responses):
+            if store:
+                store.evict()
+
+    def until_deadline(self, repos: Iterator[Repo]) -> Iterator[Repo]:
+        for repo in repos:
+            if self.drone.requester.expired():
+                l.warning("Not considering %s and all following repositories, the run exceeded its deadline.",
+                          repo.full_name)
+                return
+            yield repo
+
+    def run_repo(self, repo: Repo, froms: List[str], source: Repo, dry_run: bool, collapse: bool,
+                 prefetcher: ThreadPoolExecutor = None,
+                 downstream: Downstream = None) -> Optional[Tuple[BuildTrigger, int]]:
+        # the build trigger of the repo and the number of builds it started, None if there is nothing to trigger
+        with self.metrics.phase("branches"):
+            branches = self.retrieve_branches(repo)
+        if not branches:
+            return None
+        verbose(self.log_potential_targets, {repo: branches})
+        prefetched_token = self.prefetch_drone_token(repo, prefetcher) if prefetcher else None
 
-        branches_of_repos_with_dockerfile = self.get_branches_of_repos_with_dockerfile(branches_of_repos, from_)
-        verbose(self.log_matching_targets, branches_of_repos_with_dockerfile)
+        with self.metrics.phase("dockerfiles"):
+            matched = self.find_matching_branches(repo, branches, froms, downstream)
+        if not matched:
+            return None
+        verbose(self.log_matching_targets, {repo: list(matched)})
 
-        build_triggers = self.create_build_triggers(branches_of_repos_with_dockerfile)
+        with self.metrics.phase("tokens"):
+            build_trigger = self.create_build_trigger(repo, list(matched), prefetched_token, matched)
+        if not build_trigger:
+            return None
+        self.log_builds_to_trigger({repo: build_trigger})
+
+        if dry_run:
+            return build_trigger, 0
+        with self.metrics.phase("triggers"):
+            return build_trigger, self.drone.trigger_builds({repo: build_trigger}, source, collapse,
+                                                            self.refresh_drone_token)
+
+    def execute(self, plan: Plan, dry_run: bool, collapse: bool = False) -> None:
+        l.info("Triggering builds of Docker repositories with FROM instruction %s as planned at %s.",
+               list_images(plan.froms), time.strftime("%Y-%m-%d %H:%M:%S", time.localtime(plan.created)))
+        with self.metrics.phase("tokens"):
+            build_triggers = self.create_build_triggers(plan.branches, plan.matched)
         self.log_builds_to_trigger(build_triggers)
+        if dry_run:
+            l.info("Aborted execution, this was only a dry run.")
+            return
+        with self.metrics.phase("triggers"):
+            builds_triggered = self.drone.trigger_builds(build_triggers, plan.source, collapse,
+                                                         self.refresh_drone_token)
+        verbose(self.log_builds_triggered, builds_triggered)
+
+    def run_cascade(self, froms: List[str], source: Repo, dry_run: bool, collapse: bool, image_template: str,
+                    timeout: int, interval: int) -> None:
+        l.info("Triggering builds of Docker repositories depending directly or transitively on %s.",
+               list_images(froms))
+
+        with self.metrics.phase("repos"):
+            repos = self.drone.retrieve_repos(self.targets)
+        with self.metrics.phase("branches"):
+            branches_of_repos = self.get_branches_of_repos(repos)
+        verbose(self.log_potential_targets, branches_of_repos)
+
+        with self.metrics.phase("dockerfiles"):
+            images_of_branches = self.get_images_of_branches(branches_of_repos)
+        plan = plan_cascade(images_of_branches, froms, source,
+                            lambda repo: image_template.format(owner=repo.owner, name=repo.name))
+        if not plan.waves:
+            l.info("There are no builds to trigger.")
 
         builds_triggered = 0
+        built = {None}  # type: Set[Optional[Repo]]
+        for number, wave in enumerate(plan.waves, 1):
+            if self.drone.requester.expired():
+                l.warning("Not triggering wave %s of %s and the following ones, the run exceeded its deadline.",
+                          number, len(plan.waves))
+                break
+            skipped = [repo for repo in wave if not plan.parents[repo] & built]
+            for repo in skipped:
+                l.warning("Not triggering build for %s, none of the builds it depends on succeeded.", repo.full_name)
+            with self.metrics.phase("tokens"):
+                build_triggers = self.create_build_triggers({repo: branches for repo, branches in wave.items()
+                                                             if repo not in skipped})
+            l.info("Wave %s of %s:", number, len(plan.waves))
+            self.log_builds_to_trigger(build_triggers)
+            if dry_run:
+                built.update(build_triggers)
+                continue
+
+            with self.metrics.phase("triggers"):
+                builds = self.drone.start_builds(build_triggers, source, collapse, self.refresh_drone_token)
+            builds_triggered += sum(len(numbers) for numbers in builds.values())
+            if number < len(plan.waves):
+                l.info("Waiting for %s builds of wave %s to finish.", sum(len(n) for n in builds.values()), number)
+                with self.metrics.phase("waiting"):
+                    built.update(self.drone.wait_for_builds(builds, timeout, interval))
+
         if dry_run:
             l.info("Aborted execution, this was only a dry run.")
-        else:
-            builds_triggered = self.drone.trigger_builds(build_triggers, source)
+        verbose(self.targets.log_savings)
         verbose(self.log_builds_triggered, builds_triggered)
 
     def get_branches_of_repos(self, repos: Repos) -> BranchesOfRepos:
+        repos = list(repos)
         branches_of_repos = {}
-        for repo in repos:
-            try:
-                branches_of_repo = self.gogs.retrieve_branches(repo)
-                if branches_of_repo:
-                    branches_of_repos[repo] = branches_of_repo
-            except ClientException as e:
-                l.warning("Ignoring %s, its branches could not be retrieved: %s", repo.full_name, e)
+        for repo, branches_of_repo in zip(repos, self.executor.map(self.retrieve_branches, repos)):
+            if branches_of_repo:
+                branches_of_repos[repo] = branches_of_repo
         return branches_of_repos
 
-    def get_branches_of_repos_with_dockerfile(self, branches_of_repos: BranchesOfRepos, from_: str) -> BranchesOfRepos:
-        branches_of_repos_with_dockerfile = {}
-        for repo, branches in branches_of_repos.items():
-            branches_with_dockerfiles = [branch for branch in branches if
-                                         self.searcher.has_matching_from_instruction(repo, branch, from_)]
-            if branches_with_dockerfiles:
-                branches_of_repos_with_dockerfile[repo] = branches_with_dockerfiles
-        return branches_of_repos_with_dockerfile
+    def retrieve_branches(self, repo: Repo) -> Branches:
+        try:
+            branches = self.gogs.retrieve_branches(repo, self.targets)
+            if self.state:
+                self.state.retain_branches(repo, branches)
+            return branches
+        except ClientException as e:
+            l.warning("Ignoring %s, its branches could not be retrieved: %s", repo.full_name, e)
+            return []
+
+    def find_matching_branches(self, repo: Repo, branches: Branches, froms: List[str],
+                               downstream: Downstream = None) -> Dict[Branch, str]:
+        # the matching branches and the wanted image each of them matched, commits evaluated by a previous run are
+        # answered by the image index or the state, the others are evaluated once per commit
+        evaluated = self.state.evaluated_branches(repo, downstream.evaluated_until) if downstream else set()
+        matched_of_commits = {}
+        for (_, sha1), branches_of_commit in group_by_commit({repo: branches}).items():
+            if all(branch in evaluated for branch in branches_of_commit):
+                matched_of_commits[sha1] = downstream.matched.get((repo, branches_of_commit[0]))
+                continue
+            images = self.searcher.find_from_images_of_commit(repo, branches_of_commit)
+            matched_of_commits[sha1] = matching_from(images, froms)
+        return {branch: matched_of_commits[branch.sha1] for branch in branches if matched_of_commits[branch.sha1]}
+
+    def get_images_of_branches(self, branches_of_repos: BranchesOfRepos) -> ImagesOfBranches:
+        def find_from_images(commit: Tuple[Repo, str]) -> List[str]:
+            return self.searcher.find_from_images_of_commit(commit[0], branches_of_commits[commit])
+
+        branches_of_commits = group_by_commit(branches_of_repos)
+        images_of_commits = {}  # type: Dict[Tuple[Repo, str], List[str]]
+        if self.state:
+            indexed = self.state.indexed_images()
+            for commit, branches in list(branches_of_commits.items()):
+                if all((commit[0], branch) in indexed for branch in branches):
+                    images_of_commits[commit] = indexed[(commit[0], branches[0])]
+                    del branches_of_commits[commit]
+            l.debug("Looked up %s commits in the image index, evaluating %s.",
+                    len(images_of_commits), len(branches_of_commits))
+
+        commits = list(branches_of_commits)
+        images_of_commits.update(zip(commits, self.executor.map(find_from_images, commits)))
+
+        return {repo: [(branch, images_of_commits[(repo, branch.sha1)]) for branch in branches]
+                for repo, branches in branches_of_repos.items()}
 
-    def create_build_triggers(self, branches_of_repos_with_dockerfile: BranchesOfRepos) -> BuildTriggers:
+    def create_build_triggers(self, branches_of_repos_with_dockerfile: BranchesOfRepos,
+                              matched: Dict[Repo, Dict[Branch, str]] = None) -> BuildTriggers:
+        def create_build_trigger(repo: Repo) -> Optional[BuildTrigger]:
+            return self.create_build_trigger(repo, branches_of_repos_with_dockerfile[repo],
+                                             matched=(matched or {}).get(repo))
+
+        repos = list(branches_of_repos_with_dockerfile)
         build_triggers = {}
-        for repo, branches in branches_of_repos_with_dockerfile.items():
-            try:
-                token = self.gogs.get_drone_token(repo)
-                build_triggers[repo] = BuildTrigger(branches, token)
-            except ClientException as e:
-                l.error("Not triggering build for %s: %s", repo.full_name, e)
+        for repo, build_trigger in zip(repos, self.executor.map(create_build_trigger, repos)):
+            if build_trigger:
+                build_triggers[repo] = build_trigger
         return build_triggers
 
+    def create_build_trigger(self, repo: Repo, branches: Branches, prefetched_token: Future = None,
+                             matched: Dict[Branch, str] = None) -> Optional[BuildTrigger]:
+        try:
+            token = prefetched_token.result() if prefetched_token else self.get_drone_token(repo)
+            return BuildTrigger(branches, token, {branch.name: image for branch, image in (matched or {}).items()})
+        except ClientException as e:
+            l.error("Not triggering build for %s: %s", repo.full_name, e)
+            return None
+
+    def prefetch_drone_token(self, repo: Repo, prefetcher: ThreadPoolExecutor) -> Optional[Future]:
+        # fetched while the Dockerfiles are evaluated, at the cost of fetching tokens of repos which do not match
+        if self.state and self.state.get_token(repo):
+            return None
+        return prefetcher.submit(self.get_drone_token, repo)
+
+    def get_drone_token(self, repo: Repo) -> str:
+        token = self.state.get_token(repo) if self.state else None
+        if not token:
+            token = self.gogs.get_drone_token(repo)
+            if self.state:
+                self.state.put_token(repo, token)
+        return token
+
+    def refresh_drone_token(self, repo: Repo) -> Optional[str]:
+        if self.state:
+            self.state.drop_token(repo)
+        try:
+            return self.get_drone_token(repo)
+        except ClientException as e:
+            l.error("Unable to refetch the token of %s: %s", repo.full_name, e)
+            return None
+
     @staticmethod
     def log_potential_targets(branches_of_repos: BranchesOfRepos) -> None:
         if branches_of_repos:
@@ -96,6 +321,14 @@ class TriggerPlugin(object):
         l.debug("Triggered %s builds in total.", builds_triggered)
 
 
+def group_by_commit(branches_of_repos: BranchesOfRepos) -> Dict[Tuple[Repo, str], List[Branch]]:
+    branches_of_commits = {}  # type: Dict[Tuple[Repo, str], List[Branch]]
+    for repo, branches in branches_of_repos.items():
+        for branch in branches:
+            branches_of_commits.setdefault((repo, branch.sha1), []).append(branch)
+    return branches_of_commits
+
+
 def verbose(func, *args, **kwargs):
     if l.getLogger().isEnabledFor(l.DEBUG):
         func(*args, **kwargs)
@@ -108,10 +341,81 @@ def list_repos_with_branches(repos: Dict[Repo, Union[Branches, BuildTrigger]]) -
     targets = []
     for repo, branches_or_trigger in repos.items():
         branches = branches_or_trigger.branches if hasattr(branches_or_trigger, "branches") else branches_or_trigger
-        targets.append("{}[{}]".format(repo.full_name, list_branches(branches)))
+        target = "{}[{}]".format(repo.full_name, list_branches(branches))
+        images = sorted(set(getattr(branches_or_trigger, "matched", {}).values()))
+        targets.append("{} from {}".format(target, ",".join(images)) if images else target)
     return "; ".join(targets)
 
 
+def list_images(froms: List[str]) -> str:
+    return ", ".join("'{}'".format(from_) for from_ in froms)
+
+
+def deadline_of(config: configuration.Config) -> Optional[float]:
+    return time.monotonic() + config.run_deadline if config.run_deadline else None
+
+
+def create_plugin(config: configuration.Config) -> Tuple[TriggerPlugin, Callable[[], None]]:
+    responses = ResponseCache(config.cache_dir, config.response_cache_entries) \
+        if config.cache_dir and config.response_cache_entries else None
+    # one idle keep-alive connection per worker and host is enough to avoid reconnects
+    requester = Requester(ConnectionPool(max_size=config.concurrency), config.request_timeout, config.request_retries,
+                          deadline_of(config),
+                          config.hedge_after_millis / 1000 if config.hedge_after_millis else None,
+                          config.rate_limit or None, config.max_response_size, responses)
+    metrics = Metrics()
+    ledger = TriggerLedger(config.cache_dir, config.coalesce_window) \
+        if config.cache_dir and config.coalesce_window else None
+    drone = DroneClient(requester, config.drone_api, config.drone_token, metrics, config.max_running_builds,
+                        config.build_poll_interval, ledger)
+    cache = DockerfileCache(config.cache_dir, config.cache_max_age, config.cache_max_entries) \
+        if config.cache_dir else None
+    gogs = GogsClient(requester, config.gogs_api, config.gogs_token, cache, config.dockerfile_patterns, metrics)
+    state = StateStore(config.cache_dir, config.state_max_age, config.token_max_age,
+                       json.dumps(config.dockerfile_patterns or [])) if config.cache_dir else None
+
+    def close() -> None:
+        requester.close()
+        plugin.evict()
+        for store in (cache, state, ledger, responses):
+            if store:
+                store.close()
+        try:
+            metrics.export(config.metrics_file, config.metrics_textfile)
+        except OSError as e:
+            l.warning("Unable to export metrics: %s", e)
+
+    targets = TargetFilter(config.include_repos, config.exclude_repos, config.include_branches,
+                           config.exclude_branches, config.active_only, config.max_commit_age)
+    plugin = TriggerPlugin(drone, gogs, DockerImageSearcher(gogs, state), Executor(config.concurrency), state,
+                           metrics, config.prefetch_tokens, targets)
+    return plugin, close
+
+
+def trigger_via_service(config: configuration.Config) -> None:
+    l.info("Triggering builds of Docker repositories with FROM instruction %s via %s.",
+           list_images(config.from_), config.server_url)
+    # the trigger is not retried, the service may have started builds before the response got lost
+    requester = Requester(timeout=config.request_timeout, deadline=deadline_of(config))
+    service = Client(requester, config.server_url.rstrip("/"),
+                     {"Content-Type": "application/json; charset=utf-8"})
+    if config.server_token:
+        service.add_header("Authorization", "Bearer {}".format(config.server_token))
+    request = {"from": config.from_, "source": config.source, "dry_run": config.dry_run}
+    try:
+        doc = service.request_json("/trigger", json.dumps(request).encode())
+    except ClientException as e:
+        l.error("Unable to trigger builds via %s: %s", config.server_url, e)
+        raise SystemExit(1)
+    if doc["targets"]:
+        l.info("Triggering builds for: %s", doc["targets"])
+    else:
+        l.info("There are no builds to trigger.")
+    if config.dry_run:
+        l.info("Aborted execution, this was only a dry run.")
+    l.debug("Triggered %s builds in total.", doc["triggered"])
+
+
 def main() -> None:
     l.basicConfig(format='%(asctime)s %(levelname)-8s %(message)s', datefmt='%H:%M:%S', level=l.INFO)
     config = configuration.Config.create_from_env()
@@ -120,12 +424,23 @@ def main() -> None:
         l.getLogger().setLevel(l.DEBUG)
         l.debug("Enabled verbose logging.")
 
-    requester = Requester()
-    drone = DroneClient(requester, config.drone_api, config.drone_token)
-    gogs = GogsClient(requester, config.gogs_api, config.gogs_token)
+    if config.server_url:
+        trigger_via_service(config)
+        return
 
-    trigger = TriggerPlugin(drone, gogs, DockerImageSearcher(gogs))
-    trigger.run(config.from_, Repo.from_full_name(config.source), config.dry_run)
+    trigger, close = create_plugin(config)
+    try:
+        if config.execute_plan:
+            trigger.execute(read_plan(config.plan_file), config.dry_run, config.collapse_triggers)
+        elif config.cascade:
+            trigger.run_cascade(config.from_, Repo.from_full_name(config.source), config.dry_run,
+                                config.collapse_triggers, config.cascade_image, config.cascade_timeout,
+                                config.cascade_poll_interval)
+        else:
+            trigger.run(config.from_, Repo.from_full_name(config.source), config.dry_run, config.collapse_triggers,
+                        config.plan_file)
+    finally:
+        close()
 
 
 if __name__ == "__main__":